@@ -0,0 +1,351 @@
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+from src.ixdtl_model import IxDTLModel
+from src.output_writer import OutputWriter
+from src.profiler import Profiler
+from src.tree_node import TreeNode
+
+SHAPES = ['balanced', 'caterpillar', 'yule']
+# the stages timed by the profiler of IxDTLModel
+STAGES = ['readSpeciesTree', 'originalHaplotypeTree', 'dtlProcess',
+          'dtSubtree', 'truncation', 'output']
+# cases on large species trees without hemiplasy run besides the grid,
+# shape:leaves:events, sized to finish within the default time limit
+LARGE_CASES = 'yule:4096:0.2,balanced:4096:0.2'
+
+
+def leafName(index):
+    """
+    name of the index-th species
+    """
+    return f'S{index}'
+
+
+def ultrametric(root, heights, treeHeight):
+    """
+    set the branch lengths from the heights of the nodes (by id of the
+    node), scaled so that the tree has the given height
+    """
+    scale = treeHeight / heights[id(root)]
+    for node in root.preorder(includeSelf=False):
+        node.length = (heights[id(node.parent)] - heights[id(node)]) * scale
+    return root
+
+
+def balancedTree(leaves, treeHeight, randomState):
+    """
+    every inner node splits its leaves in halves, the height of a node
+    is the depth of its subtree
+    """
+    heights = {}
+    def build(first, count):
+        node = TreeNode()
+        if count == 1:
+            node.name = leafName(first)
+            heights[id(node)] = 0.0
+            return node
+        half = count // 2
+        for child in [build(first, half), build(first + half, count - half)]:
+            node.append(child)
+        heights[id(node)] = 1.0 + max(heights[id(child)]
+            for child in node.children)
+        return node
+    return ultrametric(build(0, leaves), heights, treeHeight)
+
+
+def caterpillarTree(leaves, treeHeight, randomState):
+    """
+    every inner node has a leaf child, the k-th inner node from the
+    bottom is at height k
+    """
+    heights = {}
+    node = TreeNode(leafName(0))
+    heights[id(node)] = 0.0
+    for index in range(1, leaves):
+        leaf = TreeNode(leafName(index))
+        heights[id(leaf)] = 0.0
+        parent = TreeNode()
+        parent.append(node)
+        parent.append(leaf)
+        heights[id(parent)] = float(index)
+        node = parent
+    return ultrametric(node, heights, treeHeight)
+
+
+def yuleTree(leaves, treeHeight, randomState):
+    """
+    pure birth process from the root, with k lineages the next split
+    happens after an exponential time of rate k on a random lineage
+    """
+    root = TreeNode()
+    times = {id(root): 0.0}
+    lineages = [root]
+    now = 0.0
+    while len(lineages) < leaves:
+        now += randomState.exponential(scale=1.0 / len(lineages))
+        node = lineages.pop(randomState.choice(len(lineages)))
+        times[id(node)] = now
+        for _ in range(2):
+            child = TreeNode()
+            node.append(child)
+            lineages.append(child)
+    now += randomState.exponential(scale=1.0 / len(lineages))
+    for index, node in enumerate(lineages):
+        node.name = leafName(index)
+        times[id(node)] = now
+    if leaves == 1:
+        root.name = leafName(0)
+    heights = {key: now - value for key, value in times.items()}
+    return ultrametric(root, heights, treeHeight)
+
+
+def speciesTree(shape, leaves, treeHeight, seed):
+    """
+    newick string and total branch length of a species tree
+    """
+    randomState = np.random.RandomState(seed)
+    build = {'balanced': balancedTree, 'caterpillar': caterpillarTree,
+             'yule': yuleTree}[shape]
+    tree = build(leaves, treeHeight, randomState)
+    length = sum(node.length for node in tree.preorder(includeSelf=False))
+    return tree.toNewick(), length
+
+
+class CaseTimeout(Exception):
+    pass
+
+
+def timeout(signum, frame):
+    raise CaseTimeout('over the time limit of the case')
+
+
+def runCase(shape, leaves, events, hemiplasy, options):
+    """
+    time the stages of the simulation of the replicates on one species
+    tree with IxDTLModel.simulate and its profiler, the duplication, 
+    transfer and loss rates are such that each event is expected the 
+    given number of times on the species tree; a case that fails or runs
+    over the time limit is reported with its error and the stages of the
+    replicates that did finish
+    """
+    newick, length = speciesTree(
+        shape, leaves, options.height, options.seed)
+    rate = events / length
+    model = IxDTLModel(seed=options.seed, profile=True)
+    model.setParameters(
+        coalescent={'const': options.coalescent},
+        duplication={'const': rate}, transfer={'const': rate},
+        loss={'const': rate}, hemiplasy=hemiplasy, recombination=1,
+        verbose=False)
+    timings = {stage: [] for stage in STAGES}
+    # counters and maxima of the finished replicates
+    profiler = Profiler(enabled=True)
+    error = None
+    with tempfile.TemporaryDirectory() as path:
+        writer = OutputWriter(path=path, format=options.format)
+        signal.signal(signal.SIGALRM, timeout)
+        signal.setitimer(signal.ITIMER_REAL, options.timeout)
+        try:
+            model.readSpeciesTree(newick=newick)
+            timings['readSpeciesTree'].append(
+                model.profiler.pop()['stages']['readSpeciesTree']['time'])
+            for replicate in range(options.replicates):
+                geneTreeNewick, truncatedNewick = model.simulate()
+                with model.profiler.stage('output'):
+                    writer.write(0, replicate, geneTreeNewick, truncatedNewick)
+                stats = model.profiler.pop()
+                for stage in STAGES[1:]:
+                    timings[stage].append(
+                        stats['stages'].get(stage, {'time': 0.0})['time'])
+                profiler.merge(stats)
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            start = time.perf_counter()
+            writer.close()
+            if timings['output']:
+                timings['output'][-1] += time.perf_counter() - start
+
+    result = {
+        'shape': shape, 'leaves': leaves, 'events': events, 'rate': rate,
+        'hemiplasy': hemiplasy, 'replicates': len(timings['output']),
+        'stages': {}
+    }
+    for stage in STAGES:
+        values = timings[stage]
+        result['stages'][stage] = {
+            'mean': float(np.mean(values)) if values else None,
+            'min': min(values) if values else None,
+            'max': max(values) if values else None,
+            'total': sum(values)
+        }
+    result['total'] = sum(sum(values) for values in timings.values())
+    result['counters'] = profiler.stats['counters']
+    result['maxima'] = profiler.stats['maxima']
+    if error:
+        result['error'] = error
+    return result
+
+
+def caseKey(result):
+    return (result['shape'], result['leaves'], result['events'],
+            result['hemiplasy'])
+
+
+def compare(results, baseline, tolerance, minimum):
+    """
+    stages whose mean time grew by more than the tolerance (as a ratio)
+    over the baseline, stages faster than the minimum are ignored
+    """
+    baselineResults = {caseKey(result): result
+        for result in baseline['results']}
+    regressions = []
+    for result in results:
+        old = baselineResults.get(caseKey(result))
+        if old is None:
+            continue
+        for stage in STAGES:
+            new = result['stages'][stage]['mean']
+            previous = old['stages'].get(stage, {}).get('mean')
+            if new is None or previous is None or new < minimum:
+                continue
+            if new > tolerance * previous:
+                regressions.append((caseKey(result), stage, previous, new))
+    return regressions
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, check=True, capture_output=True,
+            text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parseList(string, cast):
+    return [cast(item) for item in string.split(',') if item]
+
+
+def main(argv):
+    parser = OptionParser('python benchmarks/simulation.py <options>')
+    parser.add_option('-s', '--sizes', dest='sizes',
+        default='4,16,64,256,1024,4096',
+        help='numbers of leaves of the species trees [Default: %default]')
+    parser.add_option('-p', '--shapes', dest='shapes',
+        default=','.join(SHAPES),
+        help='shapes of the species trees [Default: %default]')
+    parser.add_option('-r', '--events', dest='events', default='0.2,1,3',
+        help='expected numbers of duplications, of transfers and of '
+        'losses on the species tree, from which the rates are set '
+        '[Default: %default]')
+    parser.add_option('-e', '--hemiplasy', dest='hemiplasy', default='0,1',
+        help='hemiplasy options [Default: %default]')
+    parser.add_option('-l', '--large', dest='large', default=LARGE_CASES,
+        help='large cases shape:leaves:events, simulated without '
+        'hemiplasy besides the grid [Default: %default]')
+    parser.add_option('-c', '--coalescent', type='float', dest='coalescent',
+        default=0.8, help='coalescent rate [Default: %default]')
+    parser.add_option('-H', '--height', type='float', dest='height',
+        default=1.0, help='height of the species trees [Default: %default]')
+    parser.add_option('-n', '--replicates', type='int', dest='replicates',
+        default=5, help='replicates timed on each species tree '
+        '[Default: %default]')
+    parser.add_option('-T', '--timeout', type='float', dest='timeout',
+        default=60.0, help='seconds allowed for the replicates of a case '
+        '[Default: %default]')
+    parser.add_option('-f', '--format', dest='format', default='newick',
+        help='output format, newick or jsonl [Default: %default]')
+    parser.add_option('--seed', type='int', dest='seed', default=0,
+        help='seed of the species trees and of the simulation '
+        '[Default: %default]')
+    parser.add_option('-o', '--output', dest='output',
+        help='the JSON file the results are written to [Default: stdout]')
+    parser.add_option('-b', '--baseline', dest='baseline',
+        help='JSON results of an earlier run to compare with')
+    parser.add_option('-t', '--tolerance', type='float', dest='tolerance',
+        default=1.5, help='slowdown ratio over the baseline reported as '
+        'a regression [Default: %default]')
+    parser.add_option('-m', '--minimum', type='float', dest='minimum',
+        default=0.01, help='seconds under which a stage is not compared '
+        '[Default: %default]')
+    options, _ = parser.parse_args(argv)
+
+    shapes = parseList(options.shapes, str)
+    for shape in shapes:
+        if shape not in SHAPES:
+            parser.error('unknown shape: ' + shape)
+
+    cases = [(shape, leaves, events, hemiplasy)
+        for shape in shapes
+        for leaves in parseList(options.sizes, int)
+        for events in parseList(options.events, float)
+        for hemiplasy in parseList(options.hemiplasy, int)]
+    for case in parseList(options.large, str):
+        try:
+            shape, leaves, events = case.split(':')
+            case = (shape, int(leaves), float(events), 0)
+        except ValueError:
+            parser.error('invalid large case: ' + case)
+        if shape not in SHAPES:
+            parser.error('unknown shape: ' + shape)
+        if case not in cases:
+            cases.append(case)
+
+    results = []
+    for shape, leaves, events, hemiplasy in cases:
+        result = runCase(shape, leaves, events, hemiplasy, options)
+        results.append(result)
+        print(f'{shape:>11} {leaves:>6} leaves, {events:<4} events'
+              f', hemiplasy {hemiplasy}: {result["total"]:8.3f} s'
+              + (f' ({result["error"]})' if 'error' in result else ''),
+              file=sys.stderr)
+
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': {
+            'height': options.height, 'coalescent': options.coalescent,
+            'replicates': options.replicates, 'format': options.format,
+            'seed': options.seed, 'timeout': options.timeout
+        },
+        'results': results
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, options.tolerance,
+            options.minimum)
+        for key, stage, previous, new in regressions:
+            print(f'REGRESSION: {stage} on {key}: {previous * 1000:.2f} ms '
+                  f'-> {new * 1000:.2f} ms', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
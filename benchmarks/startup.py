@@ -0,0 +1,70 @@
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+# modules that must not be loaded to parse the command line
+HEAVY_MODULES = ['numpy', 'skbio', 'pandas', 'scipy', 'src.ixdtl_model']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def coldStart(command, runs):
+    """
+    median wall time in seconds of running the command in a fresh
+    interpreter
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def loadedHeavyModules():
+    """
+    heavy modules imported by the command line parsing of ixdtl.py
+    """
+    code = ('import sys, ixdtl\n'
+            'ixdtl.readCommand(["-i", "species_tree.txt"])\n'
+            'print(" ".join(m for m in %r if m in sys.modules))' % HEAVY_MODULES)
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT,
+        check=True, capture_output=True, text=True).stdout
+    return output.split()
+
+
+def main(argv):
+    parser = OptionParser('python benchmarks/startup.py <options>')
+    parser.add_option('-r', '--runs', type='int', dest='runs', default=11,
+        help='number of cold starts timed [Default: %default]')
+    parser.add_option('-b', '--budget', type='float', dest='budget',
+        default=0.1, help='seconds allowed on top of the bare interpreter '
+        'start for "ixdtl.py --help" [Default: %default]')
+    options, _ = parser.parse_args(argv)
+
+    interpreter = coldStart([sys.executable, '-c', 'pass'], options.runs)
+    cli = coldStart([sys.executable, 'ixdtl.py', '--help'], options.runs)
+    heavy = loadedHeavyModules()
+
+    print(f'interpreter start: {interpreter * 1000:.1f} ms')
+    print(f'ixdtl.py --help:   {cli * 1000:.1f} ms '
+          f'(+{(cli - interpreter) * 1000:.1f} ms, budget '
+          f'{options.budget * 1000:.1f} ms)')
+    print(f'heavy modules loaded by the command line: {heavy or "none"}')
+
+    failed = False
+    if cli - interpreter > options.budget:
+        print('FAIL: cold start of the command line is over budget')
+        failed = True
+    if heavy:
+        print('FAIL: the command line imports ' + ', '.join(heavy))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,5 +1,4 @@
 import sys
-from src.ixdtl_model import *
 
 
 def default(str):
@@ -29,6 +28,24 @@ def readCommand(argv):
                     - runs a model
                 (2) python ixdtl.py --input data/species_tree.txt
                 OR  python ixdtl.py -i data/species_tree.txt
+                (3) python ixdtl.py -i data/species_tree.txt -n 1000 -w 8
+                    - simulates 1000 gene trees with 8 worker processes
+                (4) python ixdtl.py -i data/species_tree.txt -n 1000 \\
+                        -o runs/batch_1 -f jsonl -z gzip
+                    - writes the gene trees to runs/batch_1/gene_trees.jsonl.gz
+                (5) python ixdtl.py -i data/posterior_trees.txt -w 8
+                    - simulates a gene tree on each tree of the file
+                (6) python ixdtl.py -i data/species_tree.txt -n 1000 -s 14
+                    - the same gene trees on any number of workers
+                (7) python ixdtl.py -i data/species_tree.txt -n 100 -p 1
+                    - writes the stage timings and event counts of the run
+                      to output/profile.json
+                (8) python ixdtl.py -i data/species_tree.txt -n 100 -m 1
+                    - writes the peak memory and the live objects of the 
+                      stages and dtSubtree levels to output/memprofile.json
+                (9) python ixdtl.py -i data/species_tree.txt -g 64
+                    - branches entered by 64 genes or more draw the number 
+                      of genes leaving them at once
     """
     parser = OptionParser(usageStr, add_help_option=False)
 
@@ -37,7 +54,8 @@ def readCommand(argv):
 
     parser.add_option(
         '-i', '--inputFile', dest='inputFile',
-        help='the path to an input file of a species tree',
+        help='the path to a file of one or more species trees in newick '
+            'format, or to a directory of such files',
         metavar='INPUT_FILE')
 
     parser.add_option(
@@ -83,6 +101,64 @@ def readCommand(argv):
         help=default('verbose option, 0 or 1'), metavar='VERBOSE',
         default=0)
 
+    parser.add_option(
+        '-n', '--replicates', type='int', dest='replicates',
+        help=default('number of gene trees simulated on each species tree'), 
+        metavar='REPLICATES', default=1)
+
+    parser.add_option(
+        '-w', '--workers', type='int', dest='workers',
+        help=default('number of worker processes simulating the replicates'), 
+        metavar='WORKERS', default=1)
+
+    parser.add_option(
+        '-o', '--outputPath', dest='outputPath',
+        help=default('the directory the gene trees are written to'), 
+        metavar='OUTPUT_PATH', default='./output')
+
+    parser.add_option(
+        '-f', '--outputFormat', dest='outputFormat',
+        help=default('output format, newick (one file per tree type) '
+            'or jsonl (one record per replicate)'), 
+        metavar='OUTPUT_FORMAT', default='newick')
+
+    parser.add_option(
+        '-z', '--compression', dest='compression',
+        help=default('output compression, none, gzip or zstd '
+            '(requires the zstandard package)'), 
+        metavar='COMPRESSION', default='none')
+
+    parser.add_option(
+        '-u', '--full', type='int', dest='full',
+        help=default('write the untruncated gene trees too, 0 or 1'), 
+        metavar='FULL', default=1)
+
+    parser.add_option(
+        '-s', '--seed', type='int', dest='seed',
+        help='seed of the random number generator, every replicate draws '
+            'from its own stream derived from it [Default: random]', 
+        metavar='SEED', default=None)
+
+    parser.add_option(
+        '-p', '--profile', type='int', dest='profile',
+        help=default('time the stages and count the events of the run, '
+            'written to profile.json in the output directory, 0 or 1'), 
+        metavar='PROFILE', default=0)
+
+    parser.add_option(
+        '-m', '--memprofile', type='int', dest='memprofile',
+        help=default('trace the memory of the stages and dtSubtree levels '
+            'of the run, written to memprofile.json in the output directory '
+            '(slower), 0 or 1'), 
+        metavar='MEMPROFILE', default=0)
+
+    parser.add_option(
+        '-g', '--lineageThreshold', type='int', dest='lineageThreshold',
+        help=default('branches of the coalescent entered by at least this '
+            'many genes sample the number of genes leaving them in closed '
+            'form instead of each waiting time, 0 for never'), 
+        metavar='LINEAGE_THRESHOLD', default=0)
+
     options, otherjunk = parser.parse_args(argv)
     if len(otherjunk) != 0:
         raise Exception('Command line input not understood: ' + str(otherjunk))
@@ -92,7 +168,7 @@ def readCommand(argv):
         parser.print_help()
         sys.exit()
 
-    # input file (a species tree in newick format)
+    # input file or directory (species trees in newick format)
     if not options.inputFile:
         parser.error('The input filename not given')
     args['inputFile'] = options.inputFile
@@ -120,12 +196,54 @@ def readCommand(argv):
                      str(options.verbose))
     args['verbose'] = True if options.verbose == 1 else False
 
+    # replicates and workers
+    if options.replicates < 1:
+        parser.error('Invalid number of replicates: ' + 
+                     str(options.replicates))
+    args['replicates'] = options.replicates
+    if options.workers < 1:
+        parser.error('Invalid number of workers: ' + str(options.workers))
+    args['workers'] = options.workers
+
+    # output options
+    args['outputPath'] = options.outputPath
+    if options.outputFormat not in ['newick', 'jsonl']:
+        parser.error('Invalid output format: ' + str(options.outputFormat))
+    args['outputFormat'] = options.outputFormat
+    if options.compression not in ['none', 'gzip', 'zstd']:
+        parser.error('Invalid compression: ' + str(options.compression))
+    args['compression'] = options.compression
+    if options.full != 0 and options.full != 1:
+        parser.error('Invalid full option: ' + str(options.full))
+    args['full'] = True if options.full == 1 else False
+
+    # seed option
+    if options.seed is not None and options.seed < 0:
+        parser.error('Invalid seed: ' + str(options.seed))
+    args['seed'] = options.seed
+
+    # profile option
+    if options.profile != 0 and options.profile != 1:
+        parser.error('Invalid profile option: ' + str(options.profile))
+    args['profile'] = True if options.profile == 1 else False
+    if options.memprofile != 0 and options.memprofile != 1:
+        parser.error('Invalid memprofile option: ' + str(options.memprofile))
+    args['memprofile'] = True if options.memprofile == 1 else False
+
+    # closed-form lineage counts
+    if options.lineageThreshold < 0:
+        parser.error('Invalid lineage threshold: ' + 
+                     str(options.lineageThreshold))
+    args['lineageThreshold'] = options.lineageThreshold
+
     return args
 
 
-def runModel(**args):
-    model = IxDTLModel()
-    # model = IxDTLModel(seed=14)
+def runModel(seed=None, profile=False, memprofile=False, **args):
+    # imported here so that parsing the command line (e.g., --help)
+    # does not load numpy and the model
+    from src.ixdtl_model import IxDTLModel
+    model = IxDTLModel(seed=seed, profile=profile, memprofile=memprofile)
     model.run(**args)
 
 
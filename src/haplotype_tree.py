@@ -1,7 +1,5 @@
-import skbio
 import numpy as np
 from collections import defaultdict
-from statistics import mean
 from .tree_table import *
 from .locus_tree import *
 
@@ -11,13 +9,20 @@ class HaplotypeTree:
     Nodes are represented in Tree Table which is introduced in tree_table.py
     """
 
-    def __init__(self, randomState, speciesTree):
+    def __init__(self, randomState, speciesTree, locusTreeCache=None):
+        """
+        the locus trees of the duplications and transfers are taken from 
+        the locus tree cache if given, shared by the nested trees
+        """
         self.__randomState = randomState
         self.__speciesTree = speciesTree
+        self.__locusTreeCache = locusTreeCache
 
         self.__coalescentProcess = None
         self.__treeTable = None
+        self.__speciesIds = []
         self.__eventRates = {}
+        self.__nodeEventRates = None
         self.__recombination = None
         self.__hemiplasy = None
         self.__verbose = None
@@ -36,6 +41,10 @@ class HaplotypeTree:
     def speciesTree(self):
         return self.__speciesTree
 
+    @property
+    def locusTreeCache(self):
+        return self.__locusTreeCache
+
     @property
     def coalescentProcess(self):
         return self.__coalescentProcess
@@ -50,6 +59,7 @@ class HaplotypeTree:
     @eventRates.setter
     def eventRates(self, eventRates):
         self.__eventRates = eventRates
+        self.__setNodeEventRates()
 
     @property
     def recombination(self):
@@ -63,10 +73,13 @@ class HaplotypeTree:
     def verbose(self):
         return self.__verbose
 
-    def getSkbioTree(self):
-        return self.__treeTable.skbioTree
-    def setSkbioTree(self, skbioTree):
-        self.__treeTable.skbioTree = skbioTree
+    def getTree(self):
+        return self.__treeTable.tree
+    def setTree(self, tree, treeHeight=None):
+        if treeHeight is None:
+            self.__treeTable.tree = tree
+        else:
+            self.__treeTable.graftRoot(tree, treeHeight)
 
     def getNodeById(self, id):
         return self.__treeTable.getEntryById(id)
@@ -89,32 +102,37 @@ class HaplotypeTree:
     def getDistanceToLeaf(self, nodeId, branchDistance):
         return self.__treeTable.distanceToLeaf(nodeId, branchDistance)
 
-    def initialize(self, locusTree, coalescentProcess=None, rename=True):
-        if not coalescentProcess:
+    def initialize(self, locusTree, coalescentProcess=None, rootClade=None):
+        """
+        rootClade is the clade of the gene at the top of the locus tree,
+        by default every gene of the locus tree merged into one
+        """
+        if coalescentProcess is None:
             # ordinary coalesent for constructing the original haplotype tree
             coalescentProcess, cladeSetIntoRoot = locusTree.coalescent(
                 distanceAboveRoot=float('inf'))
         self.__coalescentProcess = coalescentProcess
-
-        timeSequences = locusTree.getTimeSequences(
-            coalescentProcess=coalescentProcess)
-        # print('time sequences:')	
-        # print(timeSequences)	
-        # print()
-
-        skbioTree = self.createSkbioTree(timeSequences)
-        self.readFromSkbioTree(skbioTree, rename)
-
-        for geneNode in self.getNodes():
-            clades = geneNode.name.split('*')[:-1]
-            clades = [int(j) for j in clades]
-            geneNode.clades = clades
-            if (geneNode.children and not geneNode.splits):
-                for i in range(len(geneNode.children)):
-                    geneChildName = self.getNodeById(geneNode.children[i]).name 
-                    childClades = geneChildName.split('*')[:-1]
-                    childClades = [int(j) for j in childClades]
-                    geneNode.splits.append(childClades)
+        if rootClade is None:
+            rootClade = locusTree.getRoot().clades
+
+        tree = self.createTree(
+            coalescentProcess=coalescentProcess, rootClade=rootClade)
+        self.readFromTree(tree)
+
+        clades = self.__treeTable.clades
+        for treeNode in tree.preorder():
+            clades[treeNode.id] = treeNode.clade
+
+        # species node where the coalescent gives birth to each gene node,
+        # indexed by gene node id; a leaf clade is born in its own species
+        speciesIdsByClade = {}
+        for speciesNodeId, mergingSets in coalescentProcess.items():
+            for mergingSet in mergingSets:
+                speciesIdsByClade[mergingSet['clade']] = speciesNodeId
+        self.__speciesIds = [
+            speciesIdsByClade.get(geneNode.clades, 
+                geneNode.clades.bit_length() - 1) 
+            for geneNode in self.getNodes()]
 
     def setEventRates(self, duplicationPrmt, transferPrmt, lossPrmt):
         if ('const' not in duplicationPrmt):
@@ -138,6 +156,16 @@ class HaplotypeTree:
         else:
             self.__eventRates['l'] = np.repeat(lossPrmt['const'], 
                 len(self.getLeaves()))
+        self.__setNodeEventRates()
+
+    def __setNodeEventRates(self):
+        """
+        rates of duplication, transfer and loss in the branch above each
+        gene node, by row, i.e., the mean rates of the extant species in 
+        the clade of the node
+        """
+        self.__nodeEventRates = self.__treeTable.meanOverClades(np.column_stack(
+            [self.__eventRates[eventType] for eventType in ['d', 't', 'l']]))
 
     # If true, then new locus is indpendent of the original locus
     # (locus tree model, IxDTL model)
@@ -155,144 +183,158 @@ class HaplotypeTree:
     def setVerbose(self, verbose):
         self.__verbose = verbose
 
-    def createSkbioTree(self, timeSequences):
+    def createTree(self, coalescentProcess, rootClade):
         """
-        creat a tree structure consistent with the package skbio
-        using timeSequence
+        creat the tree structure in one pass over the merges of the coalescent process: 
+        the node of a merged clade has the couple as children and 
+        sits at the height of the merge, leaf nodes sit at height 0;
+        nodes hold their clades, they are only named for the output (nameNodes)
         """
-        skbioTree = skbio.tree.TreeNode()
-        tempTimeSequences = timeSequences.copy()
-        # remove empty entry to see if there is coalescent or not
-        for k, v in timeSequences.items():
-            if not v: del tempTimeSequences[k]
-        if len(tempTimeSequences) > 0:
-            # skbioTree.name = name of the root
-            # name at the end of the timeSequence
-            skbioTree.name = next(iter(tempTimeSequences.values()))[-1][0]
-            self.__createSkbioTreeRecurse(
-                skbioTree=skbioTree, timeSequences=timeSequences)
-            skbioTree.length = None
-        else: 
-            # empty timeSequence {speicesId: []}
-            skbioTree.name = str(next(iter(timeSequences))) + '*' # speciesid*
-            skbioTree.length = None
-        return skbioTree
-
-    # utility function used in __createSkbioTreeRecurse
-    def __distanceToParent(self, nodeName, parentName, timeSequences):
-        for leaf, sequence in timeSequences.items():
-            if (nodeName.count('*') == 1 and nodeName[0] == str(leaf)):
-                for pair in sequence:
-                    if pair[0] == parentName:
-                        return pair[1]
-            else:
-                prevPair = None
-                for pair in sequence:
-                    if (prevPair != None 
-                        and prevPair[0] == nodeName 
-                        and pair[0] == parentName):
-                        return pair[1] - prevPair[1]
-                    prevPair = pair
-        return None
-
-    # utility function used in __createSkbioTreeRecurse
-    def __starReplace(self, string, substring):
-        a = string.split('*')[:-1]
-        b = substring.split('*')[:-1]
-        diff = set(a).difference(set(b))
-        return ''.join([e + '*' for e in sorted(list(diff))])
-
-    def __createSkbioTreeRecurse(self, skbioTree, timeSequences):
-        # one node (leaf) case (trivial)
-        if skbioTree.name.count('*') == 1:
-            skbioTree.length = self.__distanceToParent(
-                nodeName=skbioTree.name, parentName=skbioTree.parent.name, 
-                timeSequences=timeSequences)
-            return
-        # two nodes case (trivial)
-        elif len(skbioTree.name) == 4:
-            childLName = skbioTree.name[:2]
-            childRName = skbioTree.name[2:]
-            childL = skbio.tree.TreeNode(
-                name=childLName, 
-                length=self.__distanceToParent(
-                    nodeName=childLName, parentName=skbioTree.name, 
-                    timeSequences=timeSequences), 
-                parent=skbioTree)
-            childR = skbio.tree.TreeNode(
-                name=childRName, 
-                length=self.__distanceToParent(
-                    nodeName=childRName, parentName=skbioTree.name, 
-                    timeSequences=timeSequences),
-                parent=skbioTree)
-            skbioTree.children = [childL, childR]
-            return
-        # otherwise 
-        else:
-            isFound = False
-            for _, sequence in timeSequences.items():
-                prevPair = None
-                for pair in sequence:
-                    if (prevPair != None and skbioTree.name == pair[0]):
-                        childLName = prevPair[0]
-                        childRName = self.__starReplace(
-                            skbioTree.name, prevPair[0])
-                        childL = skbio.tree.TreeNode(
-                            name=childLName, 
-                            length=self.__distanceToParent(
-                                nodeName=childLName, 
-                                parentName=skbioTree.name, 
-                                timeSequences=timeSequences), 
-                            parent=skbioTree)
-                        childR = skbio.tree.TreeNode(
-                            name=childRName, 
-                            length=self.__distanceToParent(
-                                nodeName=childRName, 
-                                parentName=skbioTree.name, 
-                                timeSequences=timeSequences),
-                            parent=skbioTree)
-                        self.__createSkbioTreeRecurse(
-                            skbioTree=childL, timeSequences=timeSequences)
-                        self.__createSkbioTreeRecurse(
-                            skbioTree=childR, timeSequences=timeSequences)
-                        skbioTree.children = [childL, childR]
-                        isFound = True
-                        break
-                    prevPair = pair
-                if isFound: break
-
-    def readFromSkbioTree(self, skbioTree, rename=True):
+        merges = {}
+        for mergingSets in coalescentProcess.values():
+            for mergingSet in mergingSets:
+                merges[mergingSet['clade']] = mergingSet
+
+        tree = GeneTreeNode(clade=rootClade)
+        stack = [tree]
+        while stack:
+            parent = stack.pop()
+            if parent.clade not in merges:
+                continue
+            height = merges[parent.clade]['height']
+            for clade in merges[parent.clade]['couple']:
+                child = GeneTreeNode(clade=clade)
+                child.length = height - \
+                    (merges[clade]['height'] if clade in merges else 0.0)
+                parent.append(child)
+                stack.append(child)
+        tree.length = None
+        return tree
+
+    def nameNodes(self):
+        """
+        name the gene nodes for the output in one pass: after their clades, 
+        e.g., 0b110 -> '1*2*', or their events, e.g., 'd_lv=0_id=1', with 
+        '_loss' for lost genes, then the '_lv=.._id=..' of the grafts of 
+        the nested trees they are in, innermost first; the names column 
+        of the table follows
+        """
+        stack = [(self.getTree(), '')]
+        while stack:
+            node, suffix = stack.pop()
+            if node.graft is not None:
+                suffix = node.graft + suffix
+            name = cladeToName(node.clade) if node.event is None else node.event
+            if node.lost:
+                name += '_loss'
+            node.name = name + suffix
+            for child in node.children:
+                stack.append((child, suffix))
+        self.__treeTable.refreshNames()
+        return self.getTree()
+
+    def readFromTree(self, tree):
         self.__treeTable = TreeTable()
-        self.__treeTable.createFromSkbioTree(skbioTree, rename)
+        self.__treeTable.createFromTree(tree)
 
-    def dtlProcess(self, distanceAboveRoot, event=None):
+    def dtlProcess(self, distanceAboveRoot, event=None, batched=True):
+        """
+        sample the duplication, transfer and loss events on the branches
+        of the tree, either batched per branch on an explicit stack or 
+        by the original recursion (three competing draws per event)
+        """
         events = []
-        # trivial case
-        if len(self.getNodes()) == 1:
+        # trivial case, a single gene grafted by a duplication or transfer
+        if len(self.getNodes()) == 1 and event is not None:
             distanceAboveRoot = event['distanceToGeneNode']
-        self.__dtlProcessRecurse(
-            skbioTreeNode=self.getSkbioTree(), distanceAboveRoot=distanceAboveRoot, events=events)
+        if batched:
+            self.__dtlProcessBatched(
+                treeNode=self.getTree(), distanceAboveRoot=distanceAboveRoot, events=events)
+        else:
+            self.__dtlProcessRecurse(
+                treeNode=self.getTree(), distanceAboveRoot=distanceAboveRoot, events=events)
         return events
 
-    def __getEventRateInAncestralBranch(self, eventType, clade):
-        indices = []
-        splited = clade.split('*')[:-1]
-        for index in splited:
-            indices.append(int(index))
-        return mean(self.eventRates[eventType][indices])
-
-    def __dtlProcessRecurse(self, skbioTreeNode, distanceAboveRoot, events):
-        node = self.getNodeByName(skbioTreeNode.name)
-
-        distanceD = self.randomState.exponential(
-            scale=1.0 / self.__getEventRateInAncestralBranch(
-                eventType='d', clade=node.name))
-        distanceT = self.randomState.exponential(
-            scale=1.0 / self.__getEventRateInAncestralBranch(
-                eventType='t', clade=node.name))
-        distanceL = self.randomState.exponential(
-            scale=1.0 / self.__getEventRateInAncestralBranch(
-                eventType='l', clade=node.name))
+    def __getEventRates(self, geneId):
+        """
+        duplication, transfer and loss rates in the branch above the gene
+        """
+        return self.__nodeEventRates[self.__treeTable.getRow(geneId)]
+
+    def __dtlProcessBatched(self, treeNode, distanceAboveRoot, events):
+        """
+        The competing duplication, transfer and loss draws on a branch are 
+        a Poisson process of rate d + t + l whose events are of each type 
+        with probability proportional to its rate. The waiting times 
+        (from the top of the branch down) and the types are drawn in 
+        batches sized after the expected number of events, until the
+        first loss or the bottom of the branch; the children branches
+        are sampled only if the gene is not lost.
+        """
+        eventTypes = ['d', 't', 'l']
+        stack = [(treeNode, distanceAboveRoot)]
+        while stack:
+            treeNode, branchLength = stack.pop()
+            node = self.getNodeById(treeNode.id)
+            rates = self.__getEventRates(node.id)
+            totalRate = rates.sum()
+
+            elapsed = 0.0
+            lost = False
+            # a nested tree can start below its event, i.e., no room for events
+            while totalRate > 0 and elapsed < branchLength and not lost:
+                expected = totalRate * (branchLength - elapsed)
+                size = int(expected + 3 * np.sqrt(expected)) + 1
+                times = elapsed + np.cumsum(self.randomState.exponential(
+                    scale=1.0 / totalRate, size=size))
+                count = np.searchsorted(times, branchLength)
+                types = self.randomState.choice(
+                    3, size=count, p=rates / totalRate)
+                for time, eventType in zip(times[:count], types):
+                    self.__recordEvent(events=events, node=node, 
+                        eventType=eventTypes[eventType], 
+                        distanceToGeneNode=branchLength - time)
+                    if eventType == 2:
+                        lost = True
+                        break
+                if count < size:
+                    break
+                elapsed = times[-1]
+
+            if not lost:
+                # the left child is sampled first, as in the recursion
+                for child in reversed(treeNode.children):
+                    stack.append((child, child.length))
+
+    def __recordEvent(self, events, node, eventType, distanceToGeneNode):
+        eventHeight = self.getDistanceToLeaf(node.id, 0) + distanceToGeneNode
+        if eventType == 't':
+            if eventHeight >= self.speciesTree.getTreeHeight():
+                return
+            target, originalSpeciesId = self.__findTransferTarget(
+                eventHeight=eventHeight, geneId=node.id)
+        speciesId, distanceAboveSpeciesNode = self.__mapEventToSpeciesTree(
+            geneId=node.id, eventHeight=eventHeight, speciesId=None)
+        event = {
+            'type': {'d': 'duplication', 't': 'transfer', 'l': 'loss'}[eventType],
+            'geneNodeId': node.id,      # closest gene node to the event from below
+            'distanceToGeneNode': distanceToGeneNode,
+            'eventHeight': eventHeight,
+            'speciesNodeId': speciesId,     # closest species node to the event from below
+            'distanceToSpeciesNode': distanceAboveSpeciesNode,
+            'index': -1
+        }
+        if eventType == 't':
+            event['targetSpeciesId'] = target
+        events.append(event)
+
+    def __dtlProcessRecurse(self, treeNode, distanceAboveRoot, events):
+        node = self.getNodeById(treeNode.id)
+
+        rateD, rateT, rateL = self.__getEventRates(node.id)
+        distanceD = self.randomState.exponential(scale=1.0 / rateD)
+        distanceT = self.randomState.exponential(scale=1.0 / rateT)
+        distanceL = self.randomState.exponential(scale=1.0 / rateL)
 
         # duplication happens first
         if (distanceD < min(distanceL, distanceT) and distanceD < distanceAboveRoot):
@@ -302,7 +344,6 @@ class HaplotypeTree:
             events.append({
                 'type': 'duplication',
                 'geneNodeId': node.id,      # closest gene node to the event from below
-                'geneNodeName': node.name, 
                 'distanceToGeneNode': distanceAboveRoot - distanceD,
                 'eventHeight': eventHeight,
                 'speciesNodeId': speciesId,
@@ -311,7 +352,7 @@ class HaplotypeTree:
             })
             # looking for more events on the same branch
             self.__dtlProcessRecurse(
-                skbioTreeNode=skbioTreeNode, 
+                treeNode=treeNode, 
                 distanceAboveRoot=distanceAboveRoot - distanceD, events=events)
         elif (distanceT <= min(distanceD, distanceL) and distanceT < distanceAboveRoot):
             eventHeight = self.getDistanceToLeaf(node.id, 0) + distanceAboveRoot - distanceT
@@ -321,11 +362,10 @@ class HaplotypeTree:
                     eventHeight=eventHeight, geneId=node.id)
                 speciesId, distanceAboveSpeciesNode = self.__mapEventToSpeciesTree(
                     geneId=node.id, eventHeight=eventHeight, speciesId=None)
-                if target:
+                if target is not None:
                     events.append({
                         'type': 'transfer',
                         'geneNodeId': node.id,      # closest gene node to the event from below
-                        'geneNodeName': node.name, 
                         'distanceToGeneNode': distanceAboveRoot - distanceT,
                         'targetSpeciesId': target,
                         'eventHeight': eventHeight,
@@ -334,7 +374,7 @@ class HaplotypeTree:
                         'index': -1
                     })
             self.__dtlProcessRecurse(
-                skbioTreeNode=skbioTreeNode, 
+                treeNode=treeNode, 
                 distanceAboveRoot=distanceAboveRoot - distanceT, events=events)
         elif (distanceL <= min(distanceD, distanceT) and distanceL < distanceAboveRoot):      
             # loss happens first, the seaching process stops at the loss point
@@ -344,7 +384,6 @@ class HaplotypeTree:
             events.append({
                 'type': 'loss',
                 'geneNodeId': node.id,      # closest gene node to the event from below
-                'geneNodeName': node.name, 
                 'distanceToGeneNode': distanceAboveRoot - distanceL,
                 'eventHeight': eventHeight,
                 'speciesNodeId': speciesId,     # closest species node to the event from below
@@ -354,68 +393,48 @@ class HaplotypeTree:
         else:
             # reach the end the current branch, looking for events in the 2 children branches
             if (node.children):     # if children branches exist
-                childL = skbioTreeNode.children[0]
-                childR = skbioTreeNode.children[1]
+                childL = treeNode.children[0]
+                childR = treeNode.children[1]
                 distanceToChildL = node.distanceToChildren[0]
                 distanceToChildR = node.distanceToChildren[1]
                 self.__dtlProcessRecurse(
-                    skbioTreeNode=childL, 
+                    treeNode=childL, 
                     distanceAboveRoot=distanceToChildL, events=events)
                 self.__dtlProcessRecurse(
-                    skbioTreeNode=childR, 
+                    treeNode=childR, 
                     distanceAboveRoot=distanceToChildR, events=events)
             # else: if not exist, reach the leaves of the tree, searching process stops
 
     # M function: map the event point to where it occurs in the species tree
+    # walking up from the species node of the gene, as deep as the species tree
     def __mapEventToSpeciesTree(self, geneId, eventHeight, speciesId=None):
         if speciesId == None:
             speciesId = self.__mapGeneIdToSpeciesId(geneId=geneId)
-        distanceAboveSpeciesNode = eventHeight - self.speciesTree.getDistanceToLeaf(speciesId, 0)
-        if speciesId == self.speciesTree.getRoot().id:
-            return speciesId, distanceAboveSpeciesNode
-        else:
+        rootId = self.speciesTree.getRoot().id
+        while speciesId != rootId:
             speciesIdParent = self.speciesTree.getNodeById(speciesId).parent
             speciesDistanceParent = self.speciesTree.getDistanceToLeaf(speciesIdParent, 0)
             if speciesDistanceParent > eventHeight:
-                return speciesId, distanceAboveSpeciesNode
-            else:
-                return self.__mapEventToSpeciesTree(
-                    geneId=geneId, eventHeight=eventHeight, speciesId=speciesIdParent)
+                break
+            speciesId = speciesIdParent
+        distanceAboveSpeciesNode = eventHeight - self.speciesTree.getDistanceToLeaf(speciesId, 0)
+        return speciesId, distanceAboveSpeciesNode
 
     # map the gene node to the species node where the coalesent happens to give birth to itself
     def __mapGeneIdToSpeciesId(self, geneId):
-        speciesId = None
-        geneName = self.getNodeById(geneId).name
-        if self.coalescentProcess:
-            # non-trivial case
-            for speciesNodeId, mergingSets in self.coalescentProcess.items():
-                for mergingSet in mergingSets:
-                    if (geneName in mergingSet['toSet'] 
-                        and geneName not in mergingSet['fromSet']):
-                        speciesId = speciesNodeId
-            if speciesId == None:
-                speciesId = int(geneName[:-1])
-        else:
-            # trivial case
-            speciesId = int(geneName[:-1])     
-        return speciesId
+        return self.__speciesIds[geneId]
 
     def __findTransferTarget(self, eventHeight, geneId):
-        speciesNodes = self.speciesTree.getNodes()
         originSpeciesId = self.__mapGeneIdToSpeciesId(geneId=geneId)
-        nodesList = []
-        for node in speciesNodes:
-            if node.id == originSpeciesId:
-                continue
-            if node.id == self.speciesTree.getRoot().id:
-                continue
-            parentHeight = self.speciesTree.getDistanceToLeaf(
-                self.speciesTree.getNodeById(node.parent).id, 0)
-            if parentHeight > eventHeight:
-                nodeHeight = self.speciesTree.getDistanceToLeaf(node.id, 0)
-                if nodeHeight <= eventHeight:
-                    nodesList.append(node.id)
-        return self.randomState.choice(nodesList), originSpeciesId
+        branches = self.speciesTree.getBranchesAlive(eventHeight)
+        # pick any branch alive at the event except the origin
+        originIndex = np.searchsorted(branches, originSpeciesId)
+        originAlive = (originIndex < len(branches) 
+            and branches[originIndex] == originSpeciesId)
+        index = self.randomState.choice(len(branches) - originAlive)
+        if originAlive and index >= originIndex:
+            index += 1
+        return int(branches[index]), originSpeciesId
 
     # def find_ils(self, path):
     #     for i in range(len(self.nodes)):
@@ -493,114 +512,58 @@ class HaplotypeTree:
         2. construct the corresponding new locus tree
         3. use incomplete coalescence to generate the new haplotype tree
         4. simulate all the events on the haplotype tree 
-        5. recurse
+        5. repeat with the events of the new haplotype tree, then graft it
+        the nested trees are simulated depth first on an explicit stack 
+        of frames, one per level, instead of a recursion
         """
-        eventIndex = -1
-        for event in events:
+        profiler = self.speciesTree.profiler
+        profiler.maximum('maxLevel', level)
+        # frame: [tree sampling the events, tree grafted onto, events, 
+        # index of the next event, level, eventIndex, graft], graft is the 
+        # event of the frame below creating this tree
+        stack = [[self, haplotypeTree, events, 0, level, -1, None]]
+        while stack:
+            frame = stack[-1]
+            tree, graftTree, treeEvents, position, treeLevel, eventIndex, graft = frame
+            if position == len(treeEvents):
+                # every event of the tree done, graft it on the tree below
+                profiler.memoryAtLevel(treeLevel)
+                stack.pop()
+                if graft is not None:
+                    below = stack[-1]
+                    below[0].__graftSubtree(event=graft, newHaplotypeTree=graftTree, 
+                        haplotypeTree=below[1], level=below[4], eventIndex=below[5])
+                continue
+            event = treeEvents[position]
+            frame[3] = position + 1
+            profiler.countAtLevel(treeLevel, event['type'])
             if (event['type'] == 'duplication'):
-                eventIndex = eventIndex + 1
-                speciesId, distanceAboveSpeciesNode = self.__mapEventToSpeciesTree(
+                frame[5] = eventIndex + 1
+                speciesId, distanceAboveSpeciesNode = tree.__mapEventToSpeciesTree(
                     geneId=event['geneNodeId'], eventHeight=event['eventHeight'], 
                     speciesId=None)
-                newHaplotypeTree = self.__dtSubtreeRecurse(
+                newHaplotypeTree, newEvents = tree.__createSubtree(
                     event=event, newLocusRootId=speciesId, 
-                    distanceAboveRoot=distanceAboveSpeciesNode, level=level)
-
-                for node in newHaplotypeTree.getSkbioTree().traverse():
-                    node.name = node.name + '_lv=' + str(level) + '_id=' + str(eventIndex)
-                
-                if self.verbose:
-                    print(newHaplotypeTree)
-                    print('new haplotype tree:')	
-                    print(newHaplotypeTree.getSkbioTree().ascii_art())	
-                    print('haplotype tree before:')	
-                    print(haplotypeTree.getSkbioTree().ascii_art())	
-
-                geneNodeName = event['geneNodeName']
-                geneNode = haplotypeTree.getSkbioTree().find(geneNodeName)
-                geneNodeParent = geneNode.parent
-                # 1. create new node
-                newNode = skbio.tree.TreeNode()
-                newNode.name = 'd' + '_lv=' + str(level) + '_id=' + str(eventIndex)
-                # 2. change length
-                newHaplotypeTree.getSkbioTree().length = event['eventHeight'] - newHaplotypeTree.getTreeHeight()
-                newNode.length = 0 if not geneNodeParent else geneNode.length - event['distanceToGeneNode']
-                geneNode.length = event['distanceToGeneNode']
-                # 3. change children
-                newNode.children = [geneNode, newHaplotypeTree.getSkbioTree()]
-                if geneNodeParent:
-                    for i in range(len(geneNode.parent.children)):
-                        if geneNode.parent.children[i] == geneNode:
-                            geneNode.parent.children[i] = newNode
-                            break
-                # 4. change parent
-                geneNode.parent = newNode
-                newHaplotypeTree.getSkbioTree().parent = newNode
-
-                # check root
-                if not geneNodeParent:
-                    haplotypeTree.setSkbioTree(newNode)
-                else:
-                    newNode.parent = geneNodeParent
-
-                if self.verbose:
-                    print('haplotype tree after:')	
-                    print(haplotypeTree.getSkbioTree().ascii_art())
+                    distanceAboveRoot=distanceAboveSpeciesNode)
+                profiler.maximum('maxLevel', treeLevel + 1)
+                stack.append([newHaplotypeTree, newHaplotypeTree, newEvents, 
+                    0, treeLevel + 1, -1, event])
 
             elif (event['type'] == 'transfer'):
-                eventIndex = eventIndex + 1
+                frame[5] = eventIndex + 1
                 transferTargetId = event['targetSpeciesId']
                 targetHeight = self.speciesTree.getDistanceToLeaf(transferTargetId, 0)
                 distanceAboveTarget = event['eventHeight'] - targetHeight
-                newHaplotypeTree = self.__dtSubtreeRecurse(
+                newHaplotypeTree, newEvents = tree.__createSubtree(
                     event=event, newLocusRootId=transferTargetId, 
-                    distanceAboveRoot=distanceAboveTarget, level=level)
-                
-                for node in newHaplotypeTree.getSkbioTree().traverse():
-                    node.name = node.name + '_lv=' + str(level) + '_id=' + str(eventIndex)
-
-                if self.verbose:
-                    print(newHaplotypeTree)
-                    print('new haplotype tree:')	
-                    print(newHaplotypeTree.getSkbioTree().ascii_art())	
-                    print('haplotype tree before:')	
-                    print(haplotypeTree.getSkbioTree().ascii_art())	
-                
-                geneNodeName = event['geneNodeName']
-                geneNode = haplotypeTree.getSkbioTree().find(geneNodeName)
-                geneNodeParent = geneNode.parent
-                # 1. create new node
-                newNode = skbio.tree.TreeNode()
-                newNode.name = 't' + '_lv=' + str(level) + '_id=' + str(eventIndex)
-                # 2. change length
-                newHaplotypeTree.getSkbioTree().length = event['eventHeight'] - newHaplotypeTree.getTreeHeight()
-                newNode.length = 0 if not geneNodeParent else geneNode.length - event['distanceToGeneNode']
-                geneNode.length = event['distanceToGeneNode']
-                # 3. change children
-                newNode.children = [geneNode, newHaplotypeTree.getSkbioTree()]
-                if geneNodeParent:
-                    for i in range(len(geneNode.parent.children)):
-                        if geneNode.parent.children[i] == geneNode:
-                            geneNode.parent.children[i] = newNode
-                            break
-                # 4. change parent
-                geneNode.parent = newNode
-                newHaplotypeTree.getSkbioTree().parent = newNode
-                
-                # check root
-                if not geneNodeParent:
-                    haplotypeTree.setSkbioTree(newNode)
-                else:
-                    newNode.parent = geneNodeParent
-
-                if self.verbose:
-                    print('haplotype tree after:')	
-                    print(haplotypeTree.getSkbioTree().ascii_art())
+                    distanceAboveRoot=distanceAboveTarget)
+                profiler.maximum('maxLevel', treeLevel + 1)
+                stack.append([newHaplotypeTree, newHaplotypeTree, newEvents, 
+                    0, treeLevel + 1, -1, event])
 
             elif (event['type'] == 'loss'):
-                geneNodeName = event['geneNodeName']
-                geneNode = haplotypeTree.getSkbioTree().find(geneNodeName)
-                geneNode.name = geneNode.name + '_loss'
+                geneNode = tree.treeTable.getTreeNodeById(event['geneNodeId'])
+                geneNode.lost = True
 
                 # cut tree bug here...
                 # do not cut it for now, lable the loss points and delete all of them all at once when everything done
@@ -611,44 +574,100 @@ class HaplotypeTree:
 
         return haplotypeTree
 
-    def __dtSubtreeRecurse(self, event, newLocusRootId, distanceAboveRoot, level):
-        if (event['type'] == 'duplication' or event['type'] == 'transfer'): 
-            # for transfer nodeId = target_id
-            speciesSkbioTree = self.speciesTree.getSkbioTree()
-            newLocusRootName = self.speciesTree.getNodeById(newLocusRootId).name
+    def __graftSubtree(self, event, newHaplotypeTree, haplotypeTree, level, eventIndex):
+        """
+        graft the new haplotype tree of a duplication or transfer at the
+        gene node of the event, below a new node named after the event;
+        the nodes of the new haplotype tree take the suffix of the graft
+        when they are named
+        """
+        newHaplotypeTree.getTree().graft = '_lv=' + str(level) + '_id=' + str(eventIndex)
+
+        if self.verbose:
+            newHaplotypeTree.nameNodes()
+            haplotypeTree.nameNodes()
+            print(newHaplotypeTree)
+            print('new haplotype tree:')	
+            print(newHaplotypeTree.getTree().asciiArt())	
+            print('haplotype tree before:')	
+            print(haplotypeTree.getTree().asciiArt())	
+
+        geneNode = self.treeTable.getTreeNodeById(event['geneNodeId'])
+        geneNodeParent = geneNode.parent
+        # 1. create new node
+        newNode = GeneTreeNode(
+            event=event['type'][0] + '_lv=' + str(level) + '_id=' + str(eventIndex))
+        # 2. change length
+        newHaplotypeTree.getTree().length = event['eventHeight'] - newHaplotypeTree.getTreeHeight()
+        newNode.length = 0 if geneNodeParent is None else geneNode.length - event['distanceToGeneNode']
+        geneNode.length = event['distanceToGeneNode']
+        # 3. change children
+        newNode.children = [geneNode, newHaplotypeTree.getTree()]
+        if geneNodeParent is not None:
+            for i in range(len(geneNode.parent.children)):
+                if geneNode.parent.children[i] == geneNode:
+                    geneNode.parent.children[i] = newNode
+                    break
+        # 4. change parent
+        geneNode.parent = newNode
+        newHaplotypeTree.getTree().parent = newNode
+
+        # check root
+        if geneNodeParent is None:
+            haplotypeTree.setTree(
+                newNode, treeHeight=event['eventHeight'])
+        else:
+            newNode.parent = geneNodeParent
+
+        if self.verbose:
+            haplotypeTree.nameNodes()
+            print('haplotype tree after:')	
+            print(haplotypeTree.getTree().asciiArt())
 
-            newLocusSkbioTree = speciesSkbioTree.find(newLocusRootName).deepcopy()
-            newLocusTreeNames = [node.name for node in newLocusSkbioTree.traverse()]
-            newLocusTreeNodes = [node for node in self.speciesTree.getNodes() 
-                if node.name in newLocusTreeNames]
+    def __createSubtree(self, event, newLocusRootId, distanceAboveRoot):
+        """
+        the new haplotype tree of a duplication or transfer with its 
+        events, latest first
+        """
+        # for transfer nodeId = target_id
+        # the locus tree is a view of the species subtree, no copy needed
+        if self.locusTreeCache is not None:
+            newLocusTree = self.locusTreeCache.get(
+                speciesTree=self.speciesTree, rootId=newLocusRootId, 
+                randomState=self.randomState)
+        else:
             newLocusTree = LocusTree(randomState=self.randomState)
-            newLocusTree.initialize(nodes=newLocusTreeNodes, skbioTree=newLocusSkbioTree)
-            newLocusTree.coalescentRate = self.speciesTree.coalescentRate
-
-            locusTreeCoalescentProcess = None
-            if self.hemiplasy == 1:
-                locusTreeCoalescentProcess, chosenGeneName = \
-                    newLocusTree.incompleteCoalescent(distanceAboveRoot)
-            elif self.hemiplasy == 0:
-                locusTreeCoalescentProcess = \
-                    newLocusTree.boundedCoalescent(distanceAboveRoot)
-
-            newHaplotypeTree = HaplotypeTree(
-                randomState=self.randomState, speciesTree=self.speciesTree)
-            newHaplotypeTree.initialize(
-                locusTree=newLocusTree, 
-                coalescentProcess=locusTreeCoalescentProcess, rename=False)
-            newHaplotypeTree.eventRates = self.eventRates
-
-            rootLength = event['eventHeight'] - newHaplotypeTree.getTreeHeight()
-            newHaplotypeTree.getSkbioTree().length = rootLength
-            
-            newHaplotypeTreeEvents = newHaplotypeTree.dtlProcess(
-                event=event, distanceAboveRoot=rootLength)
-            newHaplotypeTreeEvents.sort(reverse=True, key=lambda x: x['eventHeight'])
-
-            newHaplotypeTree.dtSubtree(
-                coalescentProcess=locusTreeCoalescentProcess, 
-                events=newHaplotypeTreeEvents, haplotypeTree=newHaplotypeTree, 
-                level=level + 1)
-            return newHaplotypeTree
\ No newline at end of file
+            newLocusTree.initialize(
+                speciesTree=self.speciesTree, rootId=newLocusRootId)
+
+        locusTreeCoalescentProcess = None
+        chosenGene = None
+        if self.hemiplasy == 1:
+            locusTreeCoalescentProcess, chosenGene = \
+                newLocusTree.incompleteCoalescent(distanceAboveRoot)
+        elif self.hemiplasy == 0:
+            locusTreeCoalescentProcess = \
+                newLocusTree.boundedCoalescent(distanceAboveRoot)
+
+        newHaplotypeTree = HaplotypeTree(
+            randomState=self.randomState, speciesTree=self.speciesTree,
+            locusTreeCache=self.locusTreeCache)
+        newHaplotypeTree.initialize(
+            locusTree=newLocusTree, 
+            coalescentProcess=locusTreeCoalescentProcess, 
+            rootClade=chosenGene)
+        newHaplotypeTree.eventRates = self.eventRates
+        # the options hold for every nested tree, without the hemiplasy
+        # option the trees nested in this one would take an unbounded 
+        # coalescent, whose root can lie above their event
+        newHaplotypeTree.setRecombination(recombination=self.recombination)
+        newHaplotypeTree.setHemiplasy(hemiplasy=self.hemiplasy)
+        newHaplotypeTree.setVerbose(verbose=self.verbose)
+
+        rootLength = event['eventHeight'] - newHaplotypeTree.getTreeHeight()
+        newHaplotypeTree.getTree().length = rootLength
+        
+        newHaplotypeTreeEvents = newHaplotypeTree.dtlProcess(
+            event=event, distanceAboveRoot=rootLength)
+        newHaplotypeTreeEvents.sort(reverse=True, key=lambda x: x['eventHeight'])
+        return newHaplotypeTree, newHaplotypeTreeEvents
@@ -1,15 +1,35 @@
+import os
 import numpy as np
+import functools
+import multiprocessing
 from .species_tree import *
 from .haplotype_tree import *
+from .output_writer import *
+from .profiler import *
 from .exception import *
 
 
 class IxDTLModel:
 
-    # def __init__(self, seed=0):
-    #     self.__randomState = np.random.RandomState(seed)
-    def __init__(self):
-        self.__randomState = np.random.RandomState()
+    def __init__(self, seed=None, profile=False, memprofile=False, 
+        locusTreeCacheSize=1024):
+        """
+        every draw goes through the random state of the model, seeded from
+        the seed sequence of the given seed (from the OS entropy if None); 
+        run seeds each replicate with its own child of the seed sequence;
+        with profile, the stages are timed and the events counted, with
+        memprofile, the memory of the stages and levels is traced as well
+        (see profiler.py); the locus trees of the duplications and transfers
+        are kept in an LRU cache of the given size across the replicates, 
+        no cache if 0
+        """
+        self.__seedSequence = np.random.SeedSequence(seed)
+        self.__randomState = np.random.RandomState(
+            np.random.MT19937(self.__seedSequence))
+        self.__profile = profile
+        self.__profiler = Profiler(enabled=profile, memory=memprofile)
+        self.__locusTreeCache = LocusTreeCache(size=locusTreeCacheSize) \
+            if locusTreeCacheSize > 0 else None
 
         self.__speciesTree = None
         self.__haplotypeTree = None
@@ -36,83 +56,200 @@ class IxDTLModel:
     def randomState(self):
         return self.__randomState
 
+    @property
+    def seedSequence(self):
+        return self.__seedSequence
+
+    @property
+    def profiler(self):
+        return self.__profiler
+
+    @property
+    def locusTreeCache(self):
+        return self.__locusTreeCache
+
+    def replicateSeedSequences(self, speciesTreeIndex, replicates):
+        """
+        independent seed sequences of the replicates on the species tree
+        with the given index, spawned from its own child of the seed 
+        sequence of the model, so they only depend on the seed and on 
+        (speciesTreeIndex, replicate), not on the worker running them
+        """
+        speciesTreeSeedSequence = np.random.SeedSequence(
+            entropy=self.__seedSequence.entropy, 
+            spawn_key=self.__seedSequence.spawn_key + (speciesTreeIndex,))
+        return speciesTreeSeedSequence.spawn(replicates)
+
     def run(self, inputFile, coalescentArgs, duplicationArgs, transferArgs, 
-        lossArgs, hemiplasy, recombination, verbose):
+        lossArgs, hemiplasy, recombination, verbose, replicates=1, workers=1,
+        outputPath='./output', outputFormat='newick', compression='none', 
+        full=True, lineageThreshold=None):
+        """
+        simulate the replicates on every species tree of the input and 
+        write the gene trees; when profiling, the stats of the run 
+        (merged over the workers, whose stages are timed apart in 
+        workerStages) are written to profile.json in the output 
+        directory, and the memory report to memprofile.json
+        """
+        with self.profiler.stage('run'):
+            self.__run(inputFile, replicates, workers, outputPath, 
+                outputFormat, compression, full, parameters=dict(
+                    coalescent=coalescentArgs, duplication=duplicationArgs,
+                    transfer=transferArgs, loss=lossArgs, hemiplasy=hemiplasy,
+                    recombination=recombination, verbose=verbose,
+                    lineageThreshold=lineageThreshold))
+        if self.__profile:
+            self.profiler.write(os.path.join(outputPath, 'profile.json'))
+        if self.profiler.memory:
+            self.profiler.write(os.path.join(outputPath, 'memprofile.json'),
+                stats=self.profiler.memoryStats)
+
+    def __run(self, inputFile, replicates, workers, outputPath, outputFormat,
+        compression, full, parameters):
         # set parameters
-        self.setParameters(
-            coalescent=coalescentArgs, 
-            duplication=duplicationArgs,
-            transfer=transferArgs, 
-            loss=lossArgs, 
-            hemiplasy=hemiplasy,
-            recombination=recombination,
-            verbose=verbose)
+        self.setParameters(**parameters)
+
+        # species trees are read lazily, one tree at a time, from a file 
+        # with one or more trees or from a directory of such files
+        speciesTrees = readNewickTrees(inputFile)
+
+        # one record per replicate, written on a background thread
+        writer = OutputWriter(path=outputPath, format=outputFormat, 
+            compression=compression, full=full)
+
+        # simulate the replicates, either in this process or in a pool
+        # of workers, each task carries the index of its species tree and
+        # the seed sequence of the replicate; the workers read the species
+        # trees from the input themselves, so no newick is sent to them;
+        # the pool is terminated if the run fails, the writer always closed
+        try:
+            if workers > 1:
+                tasks = ((speciesTreeIndex, replicate, seedSequence) 
+                    for speciesTreeIndex, _ in enumerate(speciesTrees)
+                    for replicate, seedSequence in enumerate(
+                        self.replicateSeedSequences(speciesTreeIndex, replicates)))
+                with multiprocessing.Pool(
+                        processes=workers, initializer=_initReplicateWorker,
+                        initargs=(inputFile, self.parameters, self.__profile, 
+                            self.profiler.memory)) as pool:
+                    self.__writeReplicates(inputFile, writer, pool.imap(
+                        functools.partial(_runReplicate, full=full), tasks, 
+                        chunksize=max(1, replicates // (4 * workers))))
+                    pool.close()
+                    pool.join()
+            else:
+                self.__writeReplicates(inputFile, writer, 
+                    self.__simulateReplicates(speciesTrees, replicates, full))
+        finally:
+            writer.close()
+
+    def __writeReplicates(self, inputFile, writer, results):
+        simulated = False
+        for speciesTreeIndex, replicate, \
+                (geneTreeNewick, geneTreeTruncatedNewick), stats in results:
+            simulated = True
+            # stats of the replicates simulated by a worker
+            self.profiler.merge(stats, worker=True)
+            if not geneTreeTruncatedNewick:
+                print('Exception: ALL LOST')
+            writer.write(speciesTreeIndex, replicate, 
+                geneTreeNewick, geneTreeTruncatedNewick)
+        if not simulated:
+            raise IxDTLError('no species tree in ' + inputFile)
+
+    def __simulateReplicates(self, speciesTrees, replicates, full):
+        for speciesTreeIndex, newick in enumerate(speciesTrees):
+            self.readSpeciesTree(newick=newick)
+            for replicate, seedSequence in enumerate(
+                    self.replicateSeedSequences(speciesTreeIndex, replicates)):
+                yield speciesTreeIndex, replicate, \
+                    self.simulate(full=full, seedSequence=seedSequence), None
+
+    def simulate(self, full=True, seedSequence=None):
+        """
+        simulate one replicate on the species tree that has been read,
+        return the full and the truncated gene trees in newick format
+        (the full tree is None if not requested, the truncated tree is 
+        None if all the genes are lost); the gene tree is truncated in 
+        place once the full tree has been written; given a seed sequence
+        the replicate draws from its own stream, otherwise the draws 
+        continue the stream of the model
+        """
+        if seedSequence is not None:
+            self.__randomState = np.random.RandomState(
+                np.random.MT19937(seedSequence))
+            self.__speciesTree.randomState = self.__randomState
+
+        profiler = self.profiler
+        profiler.count('replicates')
 
-        # read a species tree from input file
-        self.readSpeciesTree(inputFile)
+        with profiler.stage('originalHaplotypeTree'):
+            # coalescent rates are drawn for every replicate
+            self.speciesTree.setCoalescentRate(
+                coalescentPrmt=self.__parameters['coalescent'])
+            self.speciesTree.lineageThreshold = \
+                self.__parameters['lineageThreshold']
 
-        # construct the original haplotype tree according to the species tree
-        self.constructOriginalHaplotypeTree()
+            # construct the original haplotype tree according to the species tree
+            self.constructOriginalHaplotypeTree()
 
         # run dtl process
-        events = self.haplotypeTree.dtlProcess(distanceAboveRoot=0)
-        events.sort(reverse=True, key=lambda x: x['eventHeight'])
+        with profiler.stage('dtlProcess'):
+            events = self.haplotypeTree.dtlProcess(distanceAboveRoot=0)
+            events.sort(reverse=True, key=lambda x: x['eventHeight'])
 
         # run dt subtree
-        geneTree = self.haplotypeTree.dtSubtree(
-            coalescentProcess=self.haplotypeTree.coalescentProcess, 
-            events=events, haplotypeTree=self.haplotypeTree, level=0)
-        geneSkbioTree = geneTree.getSkbioTree()
-
-        # cut the tree 
-        geneTreeTruncated = geneTree
-        geneSkbioTreeTruncated = geneSkbioTree.deepcopy()
-        for node in geneSkbioTreeTruncated.traverse():
-            if (node.children 
-                and 'loss' in node.children[0].name 
-                and 'loss' in node.children[1].name):
-                geneSkbioTreeTruncated.remove_deleted(
-                    lambda x: x.name == node.name)
-        geneSkbioTreeTruncated.prune()
-        for node in geneSkbioTreeTruncated.traverse():
-            if 'loss' in node.name:
-                geneSkbioTreeTruncated.remove_deleted(
-                    lambda x: x.name == node.name)
-        geneSkbioTreeTruncated.prune()
-
-        if not geneSkbioTreeTruncated:
-                print('Exception: ALL LOST')
-                return
-            
+        with profiler.stage('dtSubtree'):
+            geneTree = self.haplotypeTree.dtSubtree(
+                coalescentProcess=self.haplotypeTree.coalescentProcess, 
+                events=events, haplotypeTree=self.haplotypeTree, level=0)
+        geneTreeNode = geneTree.getTree()
+        with profiler.stage('output'):
+            # the gene nodes are named once, for the output
+            geneTree.nameNodes()
+            geneTreeNewick = str(geneTreeNode) if full else None
+        if profiler.enabled:
+            profiler.count('fullTreeNodes', 
+                sum(1 for _ in geneTreeNode.preorder()))
+
         if self.__parameters['verbose']:
             # visualizing the untruncated tree
             print('untruncated tree:')
-            print(geneSkbioTree.ascii_art())	    
+            print(geneTreeNode.asciiArt())	    
             # check time consistency 
-            for node in geneSkbioTree.tips():	
-                print(str(geneSkbioTree.distance(node)) + ' ' + str(node.name))
+            for node in geneTreeNode.leaves():	
+                print(str(geneTreeNode.distance(node)) + ' ' + str(node.name))
+
+        # cut the tree in one pass, in place since the full tree is written
+        with profiler.stage('truncation'):
+            geneTreeNodeTruncated = geneTreeNode.truncate(
+                isLost=lambda node: node.lost, inplace=True)
+
+        if geneTreeNodeTruncated is None or not geneTreeNodeTruncated.children:
+            profiler.count('allLost')
+            return geneTreeNewick, None
+        if profiler.enabled:
+            profiler.count('truncatedTreeNodes', 
+                sum(1 for _ in geneTreeNodeTruncated.preorder()))
+            
+        if self.__parameters['verbose']:
             # visualizing the truncated tree
             print('truncated tree:')
-            print(geneSkbioTreeTruncated.ascii_art())
+            print(geneTreeNodeTruncated.asciiArt())
             # check time consistency
-            for node in geneSkbioTreeTruncated.tips():	
-                print(str(geneSkbioTreeTruncated.distance(node)) + ' ' + str(node.name))
-            print(geneSkbioTreeTruncated.ascii_art())
+            for node in geneTreeNodeTruncated.leaves():	
+                print(str(geneTreeNodeTruncated.distance(node)) + ' ' + str(node.name))
+            print(geneTreeNodeTruncated.asciiArt())
             # final gene table
-            geneTreeTruncated.readFromSkbioTree(skbioTree=geneSkbioTreeTruncated, rename=False)
-            print(geneTreeTruncated)
-                
-        # save newick to file
-        f = open('./output/gene_tree_full.newick','w')
-        f.write(str(geneSkbioTree))
-        f.close()
-
-        f = open('./output/gene_tree_truncated.newick','w')
-        f.write(str(geneSkbioTreeTruncated))
-        f.close()
+            geneTree.readFromTree(tree=geneTreeNodeTruncated)
+            print(geneTree)
+
+        with profiler.stage('output'):
+            geneTreeTruncatedNewick = str(geneTreeNodeTruncated)
+        return geneTreeNewick, geneTreeTruncatedNewick
 
     def setParameters(self, coalescent, duplication, transfer, loss, 
-        hemiplasy, recombination, verbose):
+        hemiplasy, recombination, verbose, lineageThreshold=None):
         if not coalescent:
             raise IxDTLError('missing coalescent parameter')
         self.__parameters['coalescent'] = coalescent
@@ -141,30 +278,47 @@ class IxDTLModel:
             raise IxDTLError('missing verbose option')
         self.__parameters['verbose'] = verbose
 
-    def readSpeciesTree(self, path):
-        self.__speciesTree = SpeciesTree(randomState=self.randomState)
+        # None or 0: the waiting times of every branch are drawn
+        if lineageThreshold is not None and lineageThreshold < 0:
+            raise IxDTLError('invalid lineage threshold: ' + str(lineageThreshold))
+        self.__parameters['lineageThreshold'] = lineageThreshold
 
-        self.speciesTree.initialize(path=path)
-
-        self.speciesTree.setCoalescentRate(
-            coalescentPrmt=self.__parameters['coalescent'])
+    def readSpeciesTree(self, path=None, newick=None):
+        with self.profiler.stage('readSpeciesTree'):
+            speciesTree = SpeciesTree(randomState=self.randomState)
+            speciesTree.initialize(path=path, newick=newick)
+        self.setSpeciesTree(speciesTree)
         
         if self.__parameters['verbose']:
             print('species tree:')	
             print(self.speciesTree)	
-            print(self.speciesTree.getSkbioTree().ascii_art())	
+            print(self.speciesTree.getTree().asciiArt())	
             print()
+
+    def setSpeciesTree(self, speciesTree):
+        """
+        reuse a species tree that has already been read, 
+        e.g., by another model in the parent process
+        """
+        if self.__locusTreeCache is not None and speciesTree is not self.__speciesTree:
+            # the locus trees of the last species tree are of no more use
+            self.__locusTreeCache.clear()
+        self.__speciesTree = speciesTree
+        self.__speciesTree.randomState = self.randomState
+        self.__speciesTree.profiler = self.profiler
             
     def constructOriginalHaplotypeTree(self):
         self.__haplotypeTree = HaplotypeTree(
-            randomState=self.randomState, speciesTree=self.speciesTree)
+            randomState=self.randomState, speciesTree=self.speciesTree,
+            locusTreeCache=self.locusTreeCache)
 
         self.haplotypeTree.initialize(locusTree=self.speciesTree)
 
         if self.__parameters['verbose']:
+            self.haplotypeTree.nameNodes()
             print('original haplotype tree:')	
             print(self.haplotypeTree)	
-            print(self.haplotypeTree.getSkbioTree().ascii_art())	
+            print(self.haplotypeTree.getTree().asciiArt())	
             print()
 
         self.haplotypeTree.setEventRates(
@@ -177,4 +331,42 @@ class IxDTLModel:
             hemiplasy=self.parameters['hemiplasy'])
         self.haplotypeTree.setVerbose(
             verbose=self.parameters['verbose'])
-        
+
+
+# the model held by each worker of the replicate pool, the species trees
+# of the input it reads lazily and the index of the one it has parsed; 
+# the tasks of a worker come in input order, so a worker parses each 
+# species tree once, and reads the input once
+_replicateModel = None
+_replicateInputFile = None
+_replicateSpeciesTrees = None
+_replicateSpeciesTreeIndex = None
+
+def _initReplicateWorker(inputFile, parameters, profile=False, memprofile=False):
+    global _replicateModel, _replicateInputFile
+    _replicateModel = IxDTLModel(profile=profile, memprofile=memprofile)
+    _replicateModel.setParameters(**parameters)
+    _replicateInputFile = inputFile
+
+def _readReplicateSpeciesTree(speciesTreeIndex):
+    global _replicateSpeciesTrees, _replicateSpeciesTreeIndex
+    if _replicateSpeciesTreeIndex is None or \
+            speciesTreeIndex < _replicateSpeciesTreeIndex:
+        _replicateSpeciesTrees = enumerate(readNewickTrees(_replicateInputFile))
+    for index, newick in _replicateSpeciesTrees:
+        if index == speciesTreeIndex:
+            _replicateModel.readSpeciesTree(newick=newick)
+            _replicateSpeciesTreeIndex = speciesTreeIndex
+            return
+    raise IxDTLError('no species tree ' + str(speciesTreeIndex) 
+        + ' in ' + _replicateInputFile)
+
+def _runReplicate(task, full=True):
+    speciesTreeIndex, replicate, seedSequence = task
+    if speciesTreeIndex != _replicateSpeciesTreeIndex:
+        _readReplicateSpeciesTree(speciesTreeIndex)
+    result = _replicateModel.simulate(full=full, seedSequence=seedSequence)
+    # the stats of the replicate are merged by the parent
+    stats = _replicateModel.profiler.pop() \
+        if _replicateModel.profiler.enabled else None
+    return speciesTreeIndex, replicate, result, stats
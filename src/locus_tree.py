@@ -1,52 +1,399 @@
+import weakref
+from collections import OrderedDict
 from .species_tree import *
 from .tree_table import *
+from .exception import *
 
 class LocusTree(SpeciesTree):
+    """
+    View of the subtree of a species tree rooted at a species node: the 
+    tree table, clades, heights and coalescent rates of the species tree 
+    are shared, the locus tree only holds the rows of the subtree; its 
+    nodes and the tables of the bounded coalescent below the root branch
+    are prepared on first use and kept, see LocusTreeCache
+    """
+    # log probability of the upper tail of the numbers of genes leaving a
+    # branch dropped from the tables of the exact bounded coalescent; 
+    # conditioning on the genes merging before the top of the root branch
+    # only favours fewer genes, so the tail stays negligible
+    tailLogProbability = -70.0
+
+    # largest number of processes sampled by the rejection sampler of 
+    # the bounded coalescent before it gives up
+    maxBoundedCoalescentAttempts = 1 << 14
 
     def __init__(self, randomState):
         super().__init__(randomState=randomState)
 
-    def initialize(self, nodes, skbioTree):
-        self.treeTable = TreeTable()
-        self.treeTable.createFromEntries(
-            entries=nodes, skbioTree=skbioTree)
+        self.__speciesTree = None
+        self.__rootId = None
+        self.__rows = None
+        self.__nodes = None
+        self.__leaves = None
+        # tables of __conditionedCoalescent and the rates they were built with
+        self.__subtreeTables = None
+        self.__subtreeTablesRates = None
+        self.__tableBytes = 0
+        self.__boundedCoalescentAttempts = 0
+
+    def __repr__(self):
+        string = '<LocusTree, \n'
+        for entry in self.getNodes():
+            string += '  ' + str(entry) + '\n'
+        string += '>'
+        return string
+
+    def __str__(self):
+        return self.__repr__()
+
+    # number of coalescent processes sampled by the last bounded coalescent
+    @property
+    def boundedCoalescentAttempts(self):
+        return self.__boundedCoalescentAttempts
+
+    # memory held by the tables of the bounded coalescent
+    @property
+    def tableBytes(self):
+        return self.__tableBytes
+
+    @property
+    def speciesTree(self):
+        return self.__speciesTree
+
+    def initialize(self, speciesTree, rootId):
+        """
+        root the view at the species node rootId, nothing is copied
+        """
+        self.__speciesTree = speciesTree
+        self.__rootId = rootId
+        self.__rows = speciesTree.treeTable.getSubtreeRows(rootId)
+        self.__nodes = None
+        self.__leaves = None
+        self.__subtreeTables = None
+        self.__subtreeTablesRates = None
+        self.__tableBytes = 0
+        self.treeTable = speciesTree.treeTable
+        self.coalescentRate = speciesTree.coalescentRate
+        self.branchCoalescentRate = speciesTree.branchCoalescentRate
+        self.lineageThreshold = speciesTree.lineageThreshold
+        self.profiler = speciesTree.profiler
+
+    def getTree(self):
+        return self.__speciesTree.getTreeNodeById(self.__rootId)
+
+    # nodes of the subtree sorted by id as in the species tree, 
+    # children before parents
+    def getNodes(self):
+        if self.__nodes is None:
+            self.__nodes = [TreeTableEntry(self.treeTable, row) 
+                for row in np.sort(self.__rows).tolist()]
+        return self.__nodes
+
+    def getRoot(self):
+        return self.treeTable.getEntryById(self.__rootId)
+
+    def getLeaves(self):
+        if self.__leaves is None:
+            isLeaf = self.treeTable.children[self.__rows, 0] < 0
+            self.__leaves = [TreeTableEntry(self.treeTable, row) 
+                for row in self.__rows[isLeaf].tolist()]
+        return self.__leaves
+
+    def getTreeHeight(self):
+        return self.getDistanceToLeaf(self.__rootId, 0)
 
     # bounded coalescent for the locus tree model
-    # keep trying until every gene merged in time
-    def boundedCoalescent(self, distanceAboveRoot):
-        coalescentProcess, genesIntoRoot = self.coalescent(distanceAboveRoot)
-        if len(genesIntoRoot) == 1:
-            return coalescentProcess
-        else:
-            return self.boundedCoalescent(distanceAboveRoot)
+    # every gene has to merge before the top of the root branch
+    def boundedCoalescent(self, distanceAboveRoot, exact=True):
+        self.profiler.count('boundedCoalescents')
+        rootId = self.getRoot().id
+        if (len(self.getLeaves()) > 1 and not 
+                self._getCoalescentRateInBranch(rootId) * distanceAboveRoot > 0):
+            raise IxDTLError('no coalescent can happen in the root branch of '
+                f'the locus tree at species node {rootId}, of length '
+                f'{distanceAboveRoot}, so its genes cannot merge into one')
+        if exact:
+            return self.__conditionedCoalescent(distanceAboveRoot)
+
+        # keep trying until every gene merged in time
+        self.__boundedCoalescentAttempts = 0
+        while self.__boundedCoalescentAttempts < self.maxBoundedCoalescentAttempts:
+            self.__boundedCoalescentAttempts += 1
+            coalescentProcess, genesIntoRoot = self.coalescent(distanceAboveRoot)
+            if len(genesIntoRoot) == 1:
+                self.profiler.count('boundedCoalescentRetries', 
+                    self.__boundedCoalescentAttempts - 1)
+                return coalescentProcess
+        raise IxDTLError(f'the genes of the locus tree at species node {rootId} '
+            f'did not merge into one in {self.__boundedCoalescentAttempts} '
+            'coalescent processes')
+
+    def __conditionedCoalescent(self, distanceAboveRoot):
+        """
+        Direct sampler of the bounded coalescent, no process is rejected:
+        1. bottom-up, the distributions of the numbers of genes entering 
+           and leaving each branch are computed from the transition 
+           probabilities of the coalescent within a branch
+        2. top-down, starting from one gene leaving the root branch, 
+           the number of genes entering each branch and leaving its 
+           children are sampled conditioned on the numbers above
+        3. bottom-up, the coalescent events are sampled in each branch
+           conditioned on the numbers of genes entering and leaving it
+        The distributions are kept in log space, conditioning on one gene
+        leaving the root branch can select numbers of genes whose 
+        probabilities underflow
+        """
+        tables = self.__getSubtreeTables()
+        self.__boundedCoalescentAttempts = 1
+        rootId = self.getRoot().id
+
+        # 1. entering[id][i] = log P(i genes entering the branch above node id)
+        # leaving[id][j] = log P(j genes leaving the branch above node id);
+        # only the root branch depends on distanceAboveRoot, and only 
+        # through the genes leaving it, which are conditioned on;
+        # branches are (id, children, distance to parent), children first
+        branches, coalescentRates, entering, leaving = tables
+        branchLengths = {id: distanceToParent 
+            for id, _, distanceToParent in branches}
+        branchLengths[rootId] = distanceAboveRoot
+
+        # 2. numbers of genes entering and leaving each branch
+        enteringCount = {}
+        leavingCount = {rootId: 1}
+        for id, children, _ in reversed(branches):
+            if not children:
+                # one gene enters and leaves the branch of a leaf
+                enteringCount[id] = 1
+                continue
+            column = self._logLineageCountColumn(
+                n=len(entering[id]) - 1, m=leavingCount[id], 
+                coalescentRate=coalescentRates[id], 
+                branchLength=branchLengths[id])
+            enteringCount[id] = self.__sampleLogWeights(entering[id] + column)
+            if enteringCount[id] is None:
+                raise IxDTLError('no number of genes entering the branch '
+                    f'above species node {id} can leave {leavingCount[id]}')
+            # split the genes entering the branch between the children
+            childL, childR = children
+            counts = np.arange(enteringCount[id] + 1)
+            logWeights = np.full(len(counts), -np.inf)
+            valid = ((counts < len(leaving[childL])) 
+                & (counts[::-1] < len(leaving[childR])))
+            logWeights[valid] = (leaving[childL][counts[valid]] 
+                + leaving[childR][counts[::-1][valid]])
+            leavingCount[childL] = self.__sampleLogWeights(logWeights)
+            leavingCount[childR] = enteringCount[id] - leavingCount[childL]
+
+        # 3. coalescent events given the numbers of genes
+        coalescentProcess = defaultdict(list)
+        cladeSet = {}
+        for id, children, _ in branches:
+            genes = [1 << id] if not children else \
+                cladeSet[children[0]] + cladeSet[children[1]]
+            fakeDistances = self._conditionedCoalescentDistances(
+                n=len(genes), m=leavingCount[id], 
+                coalescentRate=coalescentRates[id], 
+                branchLength=branchLengths[id])
+            cladeSet[id] = self._mergeGenes(
+                nodeId=id, genes=genes, fakeDistances=fakeDistances,
+                coalescentProcess=coalescentProcess) \
+                if len(fakeDistances) else genes
+        return coalescentProcess
+
+    def __sampleLogWeights(self, logWeights):
+        # index drawn with probabilities proportional to exp(logWeights), 
+        # as randomState.choice draws it; None if every weight is zero
+        top = logWeights.max()
+        if top == -np.inf:
+            return None
+        weights = np.exp(logWeights - top)
+        cumulative = np.cumsum(weights)
+        cumulative /= cumulative[-1]
+        return int(cumulative.searchsorted(
+            self.randomState.random_sample(), side='right'))
+
+    def __getSubtreeTables(self):
+        """
+        branches, coalescent rates and log distributions of the numbers of
+        genes entering and leaving the branches of the locus tree, but the
+        genes leaving the root branch, without their upper tails (see 
+        tailLogProbability), which bounds the numbers of genes the 
+        transitions are summed up for; rebuilt when the coalescent rates 
+        of the species tree change
+        """
+        if self.__subtreeTablesRates is self.branchCoalescentRate:
+            return self.__subtreeTables
+        self.__subtreeTables = None
+        self.__subtreeTablesRates = self.branchCoalescentRate
+        self.__tableBytes = 0
+        rootId = self.getRoot().id
+        branches = [(node.id, node.children, node.distanceToParent) 
+            for node in self.getNodes()]
+
+        coalescentRates = {}
+        entering = {}
+        leaving = {}
+        for id, children, distanceToParent in branches:
+            if not children:
+                entering[id] = np.array([-np.inf, 0.0])
+            else:
+                entering[id] = self.__logConvolve(
+                    leaving[children[0]], leaving[children[1]])
+            coalescentRates[id] = self._getCoalescentRateInBranch(id)
+            if id == rootId:
+                continue
+            leaving[id] = self._logLeavingDistribution(
+                logEntering=entering[id], coalescentRate=coalescentRates[id], 
+                branchLength=distanceToParent)
+            leaving[id] -= logSumExp(leaving[id])
+            # the numbers in the tail add up to less than exp(tailLogProbability)
+            kept = np.flatnonzero(leaving[id] 
+                > self.tailLogProbability - np.log(len(leaving[id])))
+            leaving[id] = leaving[id][:kept[-1] + 1].copy()
+        self.__subtreeTables = branches, coalescentRates, entering, leaving
+        self.__tableBytes = sum(distribution.nbytes 
+            for distributions in (entering, leaving) 
+            for distribution in distributions.values())
+        return self.__subtreeTables
+
+    def __logConvolve(self, logA, logB):
+        # log of the convolution of two distributions given in log space
+        if len(logA) < len(logB):
+            logA, logB = logB, logA
+        convolution = np.full(len(logA) + len(logB) - 1, -np.inf)
+        for k in np.flatnonzero(logB > -np.inf).tolist():
+            convolution[k:k + len(logA)] = np.logaddexp(
+                convolution[k:k + len(logA)], logA + logB[k])
+        return convolution
 
     # incomplete coalescent for IxDTL
     def incompleteCoalescent(self, distanceAboveRoot):
         coalescentProcess, genesIntoRoot = self.coalescent(distanceAboveRoot)
-        chosenGene = np.random.choice(genesIntoRoot)
+        chosenGene = genesIntoRoot[self.randomState.choice(len(genesIntoRoot))]
         selectedCoalescentProcess = self.__selectCoalescentProcess(
             coalescentProcess, chosenGene)
         return selectedCoalescentProcess, chosenGene
     
     # seclect one haplotype tree from multiple trees
-    # sgenerated by the incomplete coalescent
+    # sgenerated by the incomplete coalescent; merges outside the chosen
+    # gene are dropped, and their distances are added to the next
+    # selected merge in the same branch
     def __selectCoalescentProcess(self, coalescentProcess, chosenGene):
         selectedCoalescentProcess = defaultdict(list)
         for speciesNodeId, mergingSets in coalescentProcess.items():
+            distance = 0.0
             for mergingSet in mergingSets:
-                distance = mergingSet['distance']
-                fromSet = []
-                toSet = []
-                for clade in mergingSet['fromSet']:
-                    if self._starInSet(target=clade, clade=chosenGene):
-                        fromSet.append(clade)
-                for clade in mergingSet['toSet']:
-                    if self._starInSet(target=clade, clade=chosenGene):
-                        toSet.append(clade)
-                if toSet:
+                distance += mergingSet['distance']
+                if isSubclade(target=mergingSet['clade'], clade=chosenGene):
                     selectedCoalescentProcess[speciesNodeId].append({
-                        'fromSet': fromSet, 
-                        'toSet': toSet,
-                        'distance': distance
+                        'couple': mergingSet['couple'], 
+                        'clade': mergingSet['clade'],
+                        'distance': distance,
+                        'height': mergingSet['height']
                     })
+                    distance = 0.0
         return selectedCoalescentProcess
+
+
+class LocusTreeCache:
+    """
+    Bounded LRU cache of prepared locus trees of one species tree, keyed 
+    by the id of the species node the locus tree is rooted at, so the 
+    nodes and tables of a locus tree are built once for all the 
+    duplications and transfers into the same species subtree; 
+    the least recently used locus trees are dropped beyond size entries 
+    or beyond tableBytes of tables, and a new species tree clears the 
+    cache, which only holds a weak reference to it
+    """
+    def __init__(self, size=1024, tableBytes=1 << 28):
+        self.__size = size
+        self.__maxTableBytes = tableBytes
+        self.__speciesTree = None
+        self.__locusTrees = OrderedDict()
+        # table bytes of the locus trees as last seen, and their sum
+        self.__tableBytes = {}
+        self.__totalTableBytes = 0
+        self.__lastRootId = None
+        self.__hits = 0
+        self.__misses = 0
+
+    def __len__(self):
+        return len(self.__locusTrees)
+
+    @property
+    def size(self):
+        return self.__size
+
+    @property
+    def maxTableBytes(self):
+        return self.__maxTableBytes
+
+    @property
+    def tableBytes(self):
+        self.__updateTableBytes()
+        return self.__totalTableBytes
+
+    @property
+    def hits(self):
+        return self.__hits
+
+    @property
+    def misses(self):
+        return self.__misses
+
+    @property
+    def hitRate(self):
+        lookups = self.__hits + self.__misses
+        return self.__hits / lookups if lookups else 0.0
+
+    def get(self, speciesTree, rootId, randomState):
+        """
+        the locus tree of the species subtree rooted at rootId, drawing
+        from the given random state with the current rates of the 
+        species tree
+        """
+        if self.__speciesTree is None or self.__speciesTree() is not speciesTree:
+            self.clear()
+            self.__speciesTree = weakref.ref(speciesTree)
+        # the tables are built after a locus tree is returned
+        self.__updateTableBytes()
+        locusTree = self.__locusTrees.get(rootId)
+        if locusTree is None:
+            self.__misses += 1
+            speciesTree.profiler.count('locusTreeCacheMisses')
+            locusTree = LocusTree(randomState=randomState)
+            locusTree.initialize(speciesTree=speciesTree, rootId=rootId)
+            self.__locusTrees[rootId] = locusTree
+            self.__tableBytes[rootId] = 0
+        else:
+            self.__hits += 1
+            speciesTree.profiler.count('locusTreeCacheHits')
+            self.__locusTrees.move_to_end(rootId)
+            locusTree.randomState = randomState
+            locusTree.coalescentRate = speciesTree.coalescentRate
+            locusTree.branchCoalescentRate = speciesTree.branchCoalescentRate
+            locusTree.lineageThreshold = speciesTree.lineageThreshold
+            locusTree.profiler = speciesTree.profiler
+        self.__lastRootId = rootId
+        # drop the least recently used, but the one returned
+        while len(self.__locusTrees) > 1 and (
+                len(self.__locusTrees) > self.__size 
+                or self.__totalTableBytes > self.__maxTableBytes):
+            droppedId, _ = self.__locusTrees.popitem(last=False)
+            self.__totalTableBytes -= self.__tableBytes.pop(droppedId)
+        return locusTree
+
+    def __updateTableBytes(self):
+        # the tables of the locus tree returned last may have been built
+        locusTree = self.__locusTrees.get(self.__lastRootId)
+        if locusTree is not None:
+            self.__totalTableBytes += \
+                locusTree.tableBytes - self.__tableBytes[self.__lastRootId]
+            self.__tableBytes[self.__lastRootId] = locusTree.tableBytes
+
+    def clear(self):
+        self.__locusTrees.clear()
+        self.__tableBytes.clear()
+        self.__totalTableBytes = 0
+        self.__lastRootId = None
+        self.__speciesTree = None
@@ -0,0 +1,131 @@
+import io
+import os
+import json
+import gzip
+import queue
+import threading
+from .exception import *
+
+
+class OutputWriter:
+    """
+    Writes one record per replicate on a background thread, so the
+    simulation does not wait for the disk:
+        newick: gene_tree_full.newick and gene_tree_truncated.newick,
+                one tree per line, replicates where all the genes are
+                lost are skipped in both files
+        jsonl:  gene_trees.jsonl, one object per replicate, e.g.,
+                {"speciesTree": 0, "replicate": 0, "full": "...;", 
+                 "truncated": null}
+    in the output directory, compressed with gzip (.gz) or zstd (.zst)
+    """
+    formats = ['newick', 'jsonl']
+    compressions = ['none', 'gzip', 'zstd']
+    suffixes = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path='./output', format='newick', compression='none',
+        full=True, bufferSize=1 << 20, queueSize=1024):
+        if format not in self.formats:
+            raise IxDTLError(f'unknown output format: {format}')
+        if compression not in self.compressions:
+            raise IxDTLError(f'unknown output compression: {compression}')
+        self.__path = path
+        self.__format = format
+        self.__compression = compression
+        self.__full = full
+        self.__bufferSize = bufferSize
+        self.__files = {}
+        self.__paths = []
+        self.__queue = queue.Queue(maxsize=queueSize)
+        self.__error = None
+
+        os.makedirs(path, exist_ok=True)
+        if format == 'newick':
+            if full:
+                self.__files['full'] = self.__open('gene_tree_full.newick')
+            self.__files['truncated'] = self.__open('gene_tree_truncated.newick')
+        else:
+            self.__files['jsonl'] = self.__open('gene_trees.jsonl')
+
+        self.__thread = threading.Thread(
+            target=self.__writeRecords, name='OutputWriter', daemon=True)
+        self.__thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    @property
+    def paths(self):
+        return self.__paths
+
+    def __open(self, fileName):
+        path = os.path.join(
+            self.__path, fileName + self.suffixes[self.__compression])
+        self.__paths.append(path)
+        if self.__compression == 'none':
+            return open(path, 'w', buffering=self.__bufferSize)
+        if self.__compression == 'gzip':
+            stream = gzip.GzipFile(
+                filename=path, mode='wb', compresslevel=6)
+        else:
+            try:
+                import zstandard
+            except ImportError:
+                raise IxDTLError(
+                    'zstd compression requires the zstandard package')
+            stream = zstandard.ZstdCompressor().stream_writer(
+                open(path, 'wb'), closefd=True)
+        return io.TextIOWrapper(
+            io.BufferedWriter(stream, buffer_size=self.__bufferSize),
+            encoding='utf-8')
+
+    def write(self, speciesTree, replicate, full, truncated):
+        """
+        queue the newick strings of a replicate on the species tree with
+        the given index, truncated is None if all the genes are lost
+        """
+        if self.__error:
+            raise self.__error
+        self.__queue.put((speciesTree, replicate, full, truncated))
+
+    def close(self):
+        """
+        wait for the queued records to be written and close the files
+        """
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join()
+        for f in self.__files.values():
+            f.close()
+        if self.__error:
+            raise self.__error
+
+    def __writeRecords(self):
+        while True:
+            record = self.__queue.get()
+            if record is None:
+                return
+            if self.__error:
+                continue
+            try:
+                self.__writeRecord(*record)
+            except Exception as error:
+                self.__error = error
+
+    def __writeRecord(self, speciesTree, replicate, full, truncated):
+        if self.__format == 'newick':
+            if truncated is None:
+                return
+            if self.__full:
+                self.__files['full'].write(full.rstrip('\n') + '\n')
+            self.__files['truncated'].write(truncated.rstrip('\n') + '\n')
+        else:
+            self.__files['jsonl'].write(json.dumps({
+                'speciesTree': speciesTree,
+                'replicate': replicate,
+                'full': full.rstrip('\n') if self.__full and full else None,
+                'truncated': truncated.rstrip('\n') if truncated else None
+            }) + '\n')
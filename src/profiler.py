@@ -0,0 +1,204 @@
+import gc
+import json
+import time
+import tracemalloc
+import contextlib
+from collections import defaultdict
+
+
+class Profiler:
+    """
+    Wall time of the stages of a run and counters of the simulation:
+        stages:   {name: {'time': seconds, 'calls': n}}
+        counters: {name: total}, e.g., coalescentEvents
+        maxima:   {name: largest value}, e.g., maxLevel
+        levels:   {level: {name: total}}, e.g., the events per dtSubtree level
+        workerStages: the stages timed in the worker processes, the times 
+                  are summed over the workers, so they add up to more 
+                  than the wall time of the run they are part of
+    a disabled profiler records nothing, every hook returns at once;
+    with memory, the allocations are traced (tracemalloc) and memoryStats
+    holds the peak of every stage and the largest memory in use at the 
+    end of a stage or of a dtSubtree level, with the live objects of 
+    memoryTypes counted at that high-water mark
+    """
+    # objects the memory is expected to go to
+    memoryTypes = ['TreeNode', 'GeneTreeNode', 'TreeTable', 'TreeTableEntry', 
+        'SpeciesTree', 'LocusTree', 'HaplotypeTree', 'dict', 'list', 'set', 'tuple']
+
+    # the objects are counted again once the memory in use has grown by
+    # this factor, a count walks every object tracked by the gc
+    memoryCountGrowth = 1.1
+
+    def __init__(self, enabled=False, memory=False):
+        self.__enabled = enabled or memory
+        self.__memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.reset()
+
+    @property
+    def enabled(self):
+        return self.__enabled
+
+    @property
+    def memory(self):
+        return self.__memory
+
+    @property
+    def memoryStats(self):
+        return {
+            'peak': self.__memoryPeak,
+            'stages': {name: dict(usage) 
+                for name, usage in self.__memoryStages.items()},
+            'levels': {str(level): dict(usage) 
+                for level, usage in sorted(self.__memoryLevels.items())}
+        }
+
+    @property
+    def stats(self):
+        stats = {
+            'stages': {name: dict(stage) for name, stage in self.__stages.items()},
+            'workerStages': {name: dict(stage) 
+                for name, stage in self.__workerStages.items()},
+            'counters': dict(self.__counters),
+            'maxima': dict(self.__maxima),
+            'levels': {str(level): dict(counters)
+                for level, counters in sorted(self.__levels.items())}
+        }
+        if self.__memory:
+            stats['memory'] = self.memoryStats
+        return stats
+
+    def reset(self):
+        self.__stages = defaultdict(lambda: {'time': 0.0, 'calls': 0})
+        self.__workerStages = defaultdict(lambda: {'time': 0.0, 'calls': 0})
+        self.__counters = defaultdict(int)
+        self.__maxima = {}
+        self.__levels = defaultdict(lambda: defaultdict(int))
+        self.__memoryPeak = 0
+        self.__memoryStages = {}
+        self.__memoryLevels = {}
+        # peaks of the stages running, outermost first
+        self.__openPeaks = []
+
+    def stage(self, name):
+        """
+        context manager adding the wall time of its block to the stage
+        """
+        if not self.__enabled:
+            return contextlib.nullcontext()
+        return self.__timeStage(name)
+
+    @contextlib.contextmanager
+    def __timeStage(self, name):
+        if self.__memory:
+            # the traced peak is reset for the stage, the stages it is
+            # nested in keep the peak so far
+            self.__updateOpenPeaks()
+            tracemalloc.reset_peak()
+            self.__openPeaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = self.__stages[name]
+            stage['time'] += time.perf_counter() - start
+            stage['calls'] += 1
+            if self.__memory:
+                self.__updateOpenPeaks()
+                peak = self.__openPeaks.pop()
+                self.__recordMemory(self.__memoryStages, name, peak)
+
+    def __updateOpenPeaks(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.__openPeaks = [max(openPeak, peak) for openPeak in self.__openPeaks]
+        self.__memoryPeak = max(self.__memoryPeak, peak)
+        return current
+
+    def __recordMemory(self, usages, key, peak=None):
+        current = self.__updateOpenPeaks()
+        usage = usages.setdefault(key, {'current': 0, 'objects': {}})
+        if peak is not None:
+            usage['peak'] = max(usage.get('peak', 0), peak)
+        if current > usage['current']:
+            if current > usage['current'] * self.memoryCountGrowth:
+                usage['objects'] = self.__countObjects()
+            usage['current'] = current
+
+    def __countObjects(self):
+        counts = dict.fromkeys(self.memoryTypes, 0)
+        objects = gc.get_objects()
+        for obj in objects:
+            name = type(obj).__name__
+            if name in counts:
+                counts[name] += 1
+        counts['objects'] = len(objects)
+        return counts
+
+    def memoryAtLevel(self, level):
+        """
+        memory in use at the end of a dtSubtree level
+        """
+        if self.__memory:
+            self.__recordMemory(self.__memoryLevels, level)
+
+    def count(self, name, value=1):
+        if self.__enabled:
+            self.__counters[name] += value
+
+    def maximum(self, name, value):
+        if self.__enabled and value > self.__maxima.get(name, value - 1):
+            self.__maxima[name] = value
+
+    def countAtLevel(self, level, name, value=1):
+        if self.__enabled:
+            self.__levels[level][name] += value
+
+    def merge(self, stats, worker=False):
+        """
+        add the stats of another profiler; the stages of a worker process
+        go to workerStages, apart from the wall time of this process
+        """
+        if not self.__enabled or not stats:
+            return
+        for stages, others in [
+                (self.__workerStages if worker else self.__stages, stats['stages']),
+                (self.__workerStages, stats.get('workerStages', {}))]:
+            for name, stage in others.items():
+                stages[name]['time'] += stage['time']
+                stages[name]['calls'] += stage['calls']
+        for name, value in stats['counters'].items():
+            self.__counters[name] += value
+        for name, value in stats['maxima'].items():
+            self.maximum(name, value)
+        for level, counters in stats['levels'].items():
+            for name, value in counters.items():
+                self.__levels[int(level)][name] += value
+        if self.__memory and 'memory' in stats:
+            memoryStats = stats['memory']
+            self.__memoryPeak = max(self.__memoryPeak, memoryStats['peak'])
+            for usages, others, toKey in [
+                    (self.__memoryStages, memoryStats['stages'], str), 
+                    (self.__memoryLevels, memoryStats['levels'], int)]:
+                for key, other in others.items():
+                    usage = usages.setdefault(toKey(key), 
+                        {'current': 0, 'objects': {}})
+                    if 'peak' in other:
+                        usage['peak'] = max(usage.get('peak', 0), other['peak'])
+                    if other['current'] > usage['current']:
+                        usage['current'] = other['current']
+                        usage['objects'] = other['objects']
+
+    def pop(self):
+        """
+        the stats recorded since the last reset, then reset
+        """
+        stats = self.stats
+        self.reset()
+        return stats
+
+    def write(self, path, stats=None):
+        with open(path, 'w') as f:
+            json.dump(self.stats if stats is None else stats, f, indent=2)
+            f.write('\n')
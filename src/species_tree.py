@@ -1,20 +1,36 @@
-import skbio
 import numpy as np
 from collections import defaultdict
-from statistics import mean
 from .tree_table import *
+from .profiler import *
 
 
 class SpeciesTree:
     """
     Nodes are represented in Tree Table which is introduced in tree_table.py
     """
+    # largest number of (epoch, branch) pairs kept by the epoch index,
+    # which grows as n^2 when the n nodes have distinct heights
+    epochIndexSize = 1 << 22
+
+    # largest number of transition probabilities of the numbers of genes
+    # in a branch summed up at once, see _logLeavingDistribution
+    transitionBlockSize = 1 << 16
+
+    # log(k!), grown on demand, see _logFactorials
+    __logFactorials = np.zeros(1)
 
     def __init__(self, randomState):
         self.__randomState = randomState
 
         self.__treeTable = None
         self.__coalescentRate = None
+        self.__branchCoalescentRate = None
+        self.__epochHeights = None
+        self.__epochOffsets = None
+        self.__epochBranches = None
+        self.__branches = None
+        self.__lineageThreshold = None
+        self.__profiler = Profiler()
 
     def __repr__(self):
         return str(self.__treeTable)
@@ -25,6 +41,25 @@ class SpeciesTree:
     @property
     def randomState(self):
         return self.__randomState
+    @randomState.setter
+    def randomState(self, randomState):
+        self.__randomState = randomState
+
+    # branches entering with at least this many genes sample the number
+    # of genes leaving in closed form, see __closedFormDistances
+    @property
+    def lineageThreshold(self):
+        return self.__lineageThreshold
+    @lineageThreshold.setter
+    def lineageThreshold(self, lineageThreshold):
+        self.__lineageThreshold = lineageThreshold
+
+    @property
+    def profiler(self):
+        return self.__profiler
+    @profiler.setter
+    def profiler(self, profiler):
+        self.__profiler = profiler
 
     @property
     def treeTable(self):
@@ -40,6 +75,15 @@ class SpeciesTree:
     def coalescentRate(self, coalescentRate):
         self.__coalescentRate = coalescentRate
 
+    # rate of coalescence in the branch above each node, indexed by node id,
+    # i.e., the mean rate of the extant species under the node
+    @property
+    def branchCoalescentRate(self):
+        return self.__branchCoalescentRate
+    @branchCoalescentRate.setter
+    def branchCoalescentRate(self, branchCoalescentRate):
+        self.__branchCoalescentRate = branchCoalescentRate
+
     def setCoalescentRate(self, coalescentPrmt):
         if ('const' not in coalescentPrmt):
             self.__coalescentRate = self.randomState.gamma(
@@ -48,9 +92,17 @@ class SpeciesTree:
         else:
             self.__coalescentRate = np.repeat(coalescentPrmt['const'], 
                 len(self.getLeaves()))
-
-    def getSkbioTree(self):
-        return self.__treeTable.skbioTree
+        # species node ids are the rows of the tree table; the rates are
+        # kept when they do not change, so the tables built from them 
+        # (see LocusTree) stay valid
+        branchCoalescentRate = \
+            self.__treeTable.meanOverClades(self.__coalescentRate)
+        if (self.__branchCoalescentRate is None or not np.array_equal(
+                branchCoalescentRate, self.__branchCoalescentRate)):
+            self.__branchCoalescentRate = branchCoalescentRate
+
+    def getTree(self):
+        return self.__treeTable.tree
 
     def getNodeById(self, id):
         return self.__treeTable.getEntryById(id)
@@ -61,6 +113,9 @@ class SpeciesTree:
     def getNodeByName(self, name):
         return self.__treeTable.getEntryByName(name)
 
+    def getTreeNodeById(self, id):
+        return self.__treeTable.getTreeNodeById(id)
+
     def getRoot(self):
         return self.__treeTable.root
 
@@ -73,250 +128,347 @@ class SpeciesTree:
     def getDistanceToLeaf(self, nodeId, branchDistance):
         return self.__treeTable.distanceToLeaf(nodeId, branchDistance)
 
-    def initialize(self, path):
+    def initialize(self, path=None, newick=None):
+        """
+        read the first tree of the file at path, or the given newick string
+        """
         self.__treeTable = TreeTable()
-        self.__treeTable.createFromNewickFile(path)
-        for speciesNode in self.getNodes():
-            for i in range(len(speciesNode.name)):  
-                leafName = speciesNode.name[i]
-                leafId = self.getNodeByName(leafName).id
-                speciesNode.clades.append(leafId)
-            if (speciesNode.children and not speciesNode.splits):
-                for i in range(len(speciesNode.children)):
-                    childName = self.getNodeById(speciesNode.children[i]).name
-                    split = []
-                    for j in range(len(childName)):  
-                        leafName = childName[j]
-                        leafId = self.getNodeByName(leafName).id
-                        split.append(leafId)
-                    speciesNode.splits.append(split)
+        if newick is None:
+            self.__treeTable.createFromNewickFile(path)
+        else:
+            self.__treeTable.createFromNewick(newick)
+        self.__buildClades()
+        self.__buildEpochIndex()
 
-    def coalescent(self, distanceAboveRoot):
+    def __buildClades(self):
         """
-        the main multi-species coalecent function
+        the clade of a leaf is its id, the clade of an inner node is the
+        union of the clades of its children, so node names can be any 
+        labels; ids are the rows, children before parents
         """
-        nodes = self.getNodes()
-        root = self.getRoot()
-        coalescentProcess = defaultdict(list)
-        cladeSetIntoRoot = None
+        treeTable = self.__treeTable
+        clades = treeTable.clades
+        for row, children in enumerate(treeTable.children.tolist()):
+            if children[0] < 0:
+                clades[row] = 1 << int(treeTable.ids[row])
+            else:
+                clades[row] = 0
+                for child in children:
+                    if child >= 0:
+                        clades[row] |= clades[child]
 
-        # leaves of the given species tree
-        oldLeaves = [node.id for node in nodes if not node.children]
+    def __buildEpochIndex(self):
+        """
+        one epoch per interval between consecutive node heights, 
+        epoch i = [epochHeights[i], epochHeights[i + 1]), and the branches
+        alive in it, i.e., the non-root nodes with 
+        nodeHeight <= epochHeights[i] < parentHeight, sorted by id in
+        epochBranches[epochOffsets[i]:epochOffsets[i + 1]];
+        over epochIndexSize pairs, only the branches are kept and the
+        ones alive are found by a scan
+        """
+        treeTable = self.__treeTable
+        isBranch = treeTable.ids != self.getRoot().id
+        ids = treeTable.ids[isBranch]
+        nodeHeights = treeTable.heights[isBranch]
+        parentHeights = treeTable.heights[
+            treeTable.getRows(treeTable.parents[isBranch])]
+        self.__epochHeights = np.unique(treeTable.heights)
+
+        # each branch is alive from the epoch of its node 
+        # up to the epoch before the one of its parent
+        firsts = np.searchsorted(self.__epochHeights, nodeHeights)
+        counts = np.searchsorted(self.__epochHeights, parentHeights) - firsts
+        if counts.sum() > self.epochIndexSize:
+            self.__branches = (ids, nodeHeights, parentHeights)
+            self.__epochBranches = None
+            self.__epochOffsets = None
+            return
+        self.__branches = None
+        starts = np.cumsum(counts) - counts
+        epochs = np.repeat(firsts - starts, counts) + np.arange(counts.sum())
+        branches = np.repeat(ids, counts)
+        order = np.lexsort((branches, epochs))
+        self.__epochBranches = branches[order]
+        self.__epochOffsets = np.searchsorted(
+            epochs[order], np.arange(len(self.__epochHeights) + 1))
+
+    def getBranchesAlive(self, height):
+        """
+        ids of the species nodes whose branches are alive at the given 
+        height above the bottom of the tree, sorted by id
+        """
+        if self.__branches is not None:
+            ids, nodeHeights, parentHeights = self.__branches
+            return ids[(nodeHeights <= height) & (height < parentHeights)]
+        epoch = np.searchsorted(self.__epochHeights, height, side='right') - 1
+        if epoch < 0:
+            return self.__epochBranches[:0]
+        return self.__epochBranches[
+            self.__epochOffsets[epoch]:self.__epochOffsets[epoch + 1]]
 
-        # leaves set will be updated in the loop
-        newLeaves = []
+    def coalescent(self, distanceAboveRoot):
+        """
+        the main multi-species coalecent function, one pass over the 
+        nodes, children before parents: the genes entering the branch 
+        above a node are the genes leaving the branches of its children 
+        (a single gene for a leaf), they coalesce within the branch before
+        entering the branch of the parent; the branch above the root is 
+        distanceAboveRoot long
+        """
+        self.profiler.count('coalescents')
+        rootId = self.getRoot().id
+        coalescentProcess = defaultdict(list)
 
-        # set of extant species that an ancestral gene will eventually be fixed in;
-        # cladeSet[node.id] = set of the genes at node.id
+        # cladeSet[node.id] = genes leaving the branch above node.id, as
+        # the sets of extant species they will eventually be fixed in,
+        # i.e., bitmasks (see util.py); dropped once the parent took them
         cladeSet = {}
+        for node in self.getNodes():
+            children = node.children
+            if children:
+                # the genes of the children are gathered in the longest list
+                childrenGenes = sorted(
+                    [cladeSet.pop(child) for child in children], key=len)
+                for genes in childrenGenes[:-1]:
+                    childrenGenes[-1].extend(genes)
+                cladeSet[node.id] = childrenGenes[-1]
+            else:
+                cladeSet[node.id] = [1 << node.id]
+            self.__coalescentBranch(
+                nodeId=node.id, 
+                branchLength=distanceAboveRoot 
+                    if node.id == rootId else node.distanceToParent,
+                cladeSet=cladeSet, coalescentProcess=coalescentProcess)
 
-        # avoid doing repeated coalescence: 
-        # a node will be lablled after finishing the coalesencent 
-        labelled = {}
-
-        # initialization: 
-        # every node is labelled false
-        # cladeSet[leafId] = 'leafId*' ('*' as seperater)
-        for node in nodes:
-            labelled[node.id] = False
-            cladeSet[node.id] = \
-                [str(node.id) + '*'] if not node.children else []
-
-        while True:
-            for leaf in oldLeaves:
-                # coalescent finished
-                if leaf == root.id:
-                    cladeSetIntoRoot = self.__coalescentRecurse(
-                        nodeId=root.id, branchLength=distanceAboveRoot,
-                        cladeSet=cladeSet, coalescentProcess=coalescentProcess)
-                    break
-                else:
-                    parent = self.getNodeById(leaf).parent
-                    children = self.getNodeById(parent).children
-                    # if the leaf has been labelled, skip
-                    if labelled[leaf]:
-                        continue
-                    labelled[leaf] = True
-
-                    # first make sure there are genes coming out of both children
-                    # then do coalescent within each child branch
-                    # cladeSet will be updated from the gene comming into the branch
-                    # to genes comming out of the branch
-                    if (len(cladeSet[children[0]]) != 0 
-                        and len(cladeSet[children[1]]) != 0):
-                        self.__coalescentRecurse(
-                            nodeId=children[0], 
-                            branchLength=self.getNodeById(
-                                children[0]).distanceToParent,
-                            cladeSet=cladeSet, 
-                            coalescentProcess=coalescentProcess)
-                        self.__coalescentRecurse(
-                            nodeId=children[1], 
-                            branchLength=self.getNodeById(
-                                children[1]).distanceToParent,
-                            cladeSet=cladeSet, 
-                            coalescentProcess=coalescentProcess)  
-
-                        # update cladeSet[parent] as the
-                        # union of the cladeSet of its children 
-                        cladeSet[parent] = list(set().union(
-                            cladeSet[children[0]], cladeSet[children[1]]))
-                        
-                        # if the parent is in newLeaves, do not add in any children of the parent
-                        if len(newLeaves) > 0:
-                            newLeaves = [e for e in newLeaves if e !=
-                                         children[0] and e != children[1]]
-                        newLeaves.append(parent)
-                    else:
-                        # updating leaves set
-                        newLeaves.append(leaf)
-
-            # coalesecent finished
-            if leaf == root.id:
-                break
-
-            # delete repeated items in newLeaves 
-            tempNewLeaves = [] 
-            for newLeaf in newLeaves:
-                if newLeaf not in tempNewLeaves:
-                    tempNewLeaves.append(newLeaf)
-
-            # re-initialization for the next recursion
-            # oldLeaves <- newLeaves
-            # label <- false
-            oldLeaves = tempNewLeaves.copy()
-            newLeaves = []
-            labelled = {}
-            for node in nodes:
-                labelled[node.id] = False
-
-        return coalescentProcess, cladeSetIntoRoot
-
-    def __coalescentRecurse(self, nodeId, branchLength, cladeSet, coalescentProcess):
+        return coalescentProcess, cladeSet[rootId]
+
+    def __coalescentBranch(self, nodeId, branchLength, cladeSet, coalescentProcess):
         """
-        This is the recursive part of the multispecies coalescent process:
+        This is the per-branch part of the multispecies coalescent process:
         Given a set of n genes gathering into a branch in the species tree 
-        from the bottom, whenever we come across a point of coalescence, 
-        we randomly merge 2 elements in the gene sets, and record the set 
-        before the new coalescence, named "from_set", and the set after 
-        the coalescence, named "to_set", and the distance from the last 
-        coalescent event or the bottom of the branch.
+        from the bottom, the waiting times while n, n - 1, ..., 2 genes 
+        remain are drawn in growing chunks until one falls beyond the 
+        branch, and those falling within the branch are coalescent events. 
+        At each of them we randomly merge 2 elements in the gene set, 
+        and record the merged couple, named "couple", the 
+        new clade, named "clade", the distance from the last coalescent 
+        event or the bottom of the branch, and the height of the event.
         """
-        if len(cladeSet[nodeId]) <= 1:
+        n = len(cladeSet[nodeId])
+        if n <= 1:
             return cladeSet[nodeId]
+
+        # the genes entering a branch carry every extant species under it, 
+        # and merging keeps their union, so the rate is the one of the node
+        coalescentRate = self._getCoalescentRateInBranch(nodeId)
+        if self.__lineageThreshold and n >= self.__lineageThreshold:
+            fakeDistances = self.__closedFormDistances(
+                n=n, coalescentRate=coalescentRate, branchLength=branchLength)
         else:
-            # rate of coalescence in an ancestral branch = mean of each child branch
-            coalescentRate = len(cladeSet[nodeId]) \
-                      * self.__getCoalescentRateInAncestralBranch(cladeSet[nodeId])
-            fakeDistance = self.randomState.exponential(
-                scale=1.0 / coalescentRate)
-
-            # no coalescent event anymore in this branch
-            if branchLength < fakeDistance:
-                return cladeSet[nodeId]
-            else:
-                # when coalescent, randomly merge 2 elements in the gene sets
-                # if there are more than one genes in the cladeSet, start merging
-                if len(cladeSet[nodeId]) >= 2:
-                    temp_set = sorted(cladeSet[nodeId])
-                    # choose a couple, merge them, then put it back
-                    couple = self.randomState.choice(
-                        cladeSet[nodeId], size=2, replace=False)
-                    cladeSet[nodeId] = [''.join(self.__starSorted(couple))] \
-                        + [e for e in cladeSet[nodeId] if e not in couple]
-
-                    # save process
-                    coalescentProcess[nodeId].append({
-                        'fromSet': temp_set,
-                        'toSet': cladeSet[nodeId].copy(),
-                        'distance': fakeDistance
-                    })
-                else:
-                    # stop when cladeSet only has one element
-                    return cladeSet[nodeId]
-
-                branchLength = branchLength - fakeDistance
-
-                # use recursion to simulate the case when there is
-                # more than one coalescent events in the branch
-                self.__coalescentRecurse(
-                    nodeId=nodeId, branchLength=branchLength, cladeSet=cladeSet, 
-                    coalescentProcess=coalescentProcess)
+            # a short branch sees a few of the n - 1 events at most
+            chunks = []
+            elapsed = 0.0
+            remaining = n
+            chunkSize = 8
+            while remaining > 1:
+                counts = np.arange(remaining, max(remaining - chunkSize, 1), -1)
+                distances = self.randomState.exponential(
+                    scale=1.0 / (counts * coalescentRate))
+                times = elapsed + np.cumsum(distances)
+                inBranch = int(np.searchsorted(times, branchLength, side='right'))
+                chunks.append(distances[:inBranch])
+                if inBranch < len(distances):
+                    break
+                elapsed = times[-1]
+                remaining -= len(distances)
+                chunkSize *= 2
+            fakeDistances = np.concatenate(chunks)
+        eventCount = len(fakeDistances)
+        if eventCount == 0:
+            return cladeSet[nodeId]
 
-        return cladeSet[nodeId]
+        cladeSet[nodeId] = self._mergeGenes(
+            nodeId=nodeId, genes=cladeSet[nodeId], 
+            fakeDistances=fakeDistances, 
+            coalescentProcess=coalescentProcess)
 
-    def __getCoalescentRateInAncestralBranch(self, cladeSet):
-        indices = []
-        for clade in cladeSet:
-            splited = clade.split('*')[:-1]
-            for index in splited:
-                indices.append(int(index))
-        return mean(self.coalescentRate[indices])
+        return cladeSet[nodeId]
 
-    def _starInSet(self, target, clade):
+    def __closedFormDistances(self, n, coalescentRate, branchLength):
         """
-        checking whether a given clade is in the target set
-        modified for the "*" representation
+        distances between the coalescent events of n genes entering a 
+        branch, without drawing the waiting times one by one: the number 
+        m of genes leaving is drawn as in _logLineageCountColumn, i.e., 
+        binomial with the survival probability, where no survivor counts 
+        as one gene, then the 
+        events are drawn given n and m; a branch of infinite length 
+        (above the root) leaves one gene
         """
-        if len(target) <= len(clade):
-            splited_target = target.split('*')[:-1]
-            splited_clade = clade.split('*')[:-1]
-            return set(splited_target).issubset(set(splited_clade))
-        else:
-            return False
+        survival = np.exp(-coalescentRate * branchLength)
+        m = max(int(self.randomState.binomial(n, survival)), 1)
+        self.profiler.count('closedFormBranches')
+        return self._conditionedCoalescentDistances(
+            n=n, m=m, coalescentRate=coalescentRate, branchLength=branchLength)
 
-    def __starSorted(self, couple):
+    def _mergeGenes(self, nodeId, genes, fakeDistances, coalescentProcess):
+        """
+        merge a random couple of the genes at each of the coalescent 
+        events in the branch above nodeId, given the distances between 
+        the events, and return the genes leaving the branch; 
+        each merge is recorded with its height above the bottom of the 
+        tree, so the haplotype tree can be built directly from the merges
         """
-        1*4* + 2*3* -> 1*4*2*3* -> 1*2*3*4*
+        n = len(genes)
+        eventCount = len(fakeDistances)
+        self.profiler.count('coalescentEvents', eventCount)
+        heights = self.getDistanceToLeaf(nodeId, 0) + np.cumsum(fakeDistances)
+
+        # choose a couple (i, j), i != j, among the m remaining genes 
+        # for every event
+        remaining = np.arange(n, n - eventCount, -1)
+        uniforms = self.randomState.random_sample(size=(eventCount, 2))
+        firsts = (uniforms[:, 0] * remaining).astype(int)
+        seconds = (uniforms[:, 1] * (remaining - 1)).astype(int)
+        seconds += seconds >= firsts
+
+        # merge the couple into the first slot, and move the last gene 
+        # into the second slot, so the genes stay in the first m - 1 slots
+        genes = genes.copy()
+        for k in range(eventCount):
+            m = remaining[k]
+            i, j = firsts[k], seconds[k]
+            couple = (genes[i], genes[j])
+            genes[i] = couple[0] | couple[1]
+            genes[j] = genes[m - 1]
+
+            # save process
+            coalescentProcess[nodeId].append({
+                'couple': couple,
+                'clade': couple[0] | couple[1],
+                'distance': fakeDistances[k],
+                'height': heights[k]
+            })
+        del genes[n - eventCount:]
+        return genes
+
+    def _getCoalescentRateInBranch(self, nodeId):
+        return float(self.__branchCoalescentRate[nodeId])
+
+    def _logFactorials(self, n):
         """
-        string = ''
-        for e in couple:
-            string += e
-        splited = string.split('*')[:-1]
-        splited = sorted([int(e) for e in splited])
-        return [str(e) + '*' for e in splited]
-
-    def getTimeSequences(self, coalescentProcess):
+        log(k!) for 0 <= k <= n and maybe more, shared by all the trees
+        """
+        logFactorials = SpeciesTree.__logFactorials
+        if len(logFactorials) <= n:
+            size = max(n + 1, 2 * len(logFactorials))
+            logFactorials = np.concatenate(
+                ([0.0], np.cumsum(np.log(np.arange(1, size)))))
+            SpeciesTree.__logFactorials = logFactorials
+        return logFactorials
+
+    def __logSurvival(self, coalescentRate, branchLength):
+        # log of the probabilities that a gene survives the branch or not
+        logSurvival = -coalescentRate * branchLength
+        with np.errstate(divide='ignore'):
+            logDeath = np.log(-np.expm1(logSurvival))
+        return logSurvival, logDeath
+
+    def _logLineageCountColumn(self, n, m, coalescentRate, branchLength):
+        """
+        log P(m genes leave the branch | i genes enter it), for 0 <= i <= n.
+        The waiting time with k genes is exponential with rate 
+        k * coalescentRate, which is the time of the first death in a pure 
+        death process, so for m >= 2 the number of genes leaving is 
+        binomial with survival probability exp(-coalescentRate * length), 
+        and m = 1 takes the remaining mass (the last gene never merges)
+        """
+        column = np.full(n + 1, -np.inf)
+        if m > n:
+            return column
+        logSurvival, logDeath = self.__logSurvival(coalescentRate, branchLength)
+        if m == 0 or logDeath == -np.inf:
+            # no gene can merge
+            column[m] = 0.0
+            return column
+        i = np.arange(m, n + 1)
+        if m == 1:
+            # (1 - s)^i + i s (1 - s)^(i - 1)
+            column[1:] = (i - 1) * logDeath + np.log(
+                np.exp(logDeath) + i * np.exp(logSurvival))
+        else:
+            logFactorials = self._logFactorials(n)
+            column[m:] = (logFactorials[i] - logFactorials[m] 
+                - logFactorials[i - m] + m * logSurvival + (i - m) * logDeath)
+        return column
+
+    def _logLeavingDistribution(self, logEntering, coalescentRate, branchLength):
         """
-        backward-in-time coalescent process modified data structure 
-        for constructing the coalescent tree in newick format
-        e.g.,
-        {   
-            0: [('0*1*2*', 3.49629952440356)], 
-            1: [('1*2*', 2.2767776526850145), ('0*1*2*', 3.49629952440356)], 
-            2: [('1*2*', 2.2767776526850145), ('0*1*2*', 3.49629952440356)]
-        }
+        log distribution of the number of genes leaving a branch, given 
+        the log distribution of the number entering it, i.e., the product 
+        of the distribution and the transitions of _logLineageCountColumn;
+        the transitions are summed up in blocks of rows of at most 
+        transitionBlockSize entries, the matrix is never built
         """
-        timeSequences = {}
-        for leaf in self.getLeaves():
-            timeSequences[leaf.id] = self.__findAncestors(
-                leafName=str(leaf.id) + '*', 
-                coalescentProcess=coalescentProcess)
-        return timeSequences
-
-    def __findAncestors(self, leafName, coalescentProcess):
+        n = len(logEntering) - 1
+        logSurvival, logDeath = self.__logSurvival(coalescentRate, branchLength)
+        if logDeath == -np.inf:
+            return logEntering.copy()
+        leaving = np.full(n + 1, -np.inf)
+        rows = np.flatnonzero(logEntering > -np.inf)
+        if not len(rows):
+            return leaving
+        lowest = max(int(rows[0]), 1)
+        i = np.arange(lowest, n + 1)
+        leaving[1] = logSumExp(logEntering[lowest:] + (i - 1) * logDeath 
+            + np.log(np.exp(logDeath) + i * np.exp(logSurvival)))
+        if logSurvival == -np.inf or n < 2:
+            return leaving
+
+        # log of the terms of row i and column j, the binomial coefficient
+        # split into log(i!), -log(j!) and -log((i - j)!), the last one 
+        # taken from a sliding window over the differences i - j
+        logFactorials = self._logFactorials(n)
+        rowTerms = logEntering + logFactorials[:n + 1] + np.arange(n + 1) * logDeath
+        j = np.arange(2, n + 1)
+        columnTerms = j * (logSurvival - logDeath) - logFactorials[j]
+        # -log((i - j)!) for i - j = n - 2, ..., -(n - 2), -inf if j > i
+        differences = np.full(2 * n - 3, -np.inf)
+        differences[:n - 1] = -logFactorials[n - 2::-1]
+        windows = np.lib.stride_tricks.sliding_window_view(differences, n - 1)
+        blockRows = max(1, self.transitionBlockSize // n)
+        for start in range(max(lowest, 2), n + 1, blockRows):
+            stop = min(start + blockRows, n + 1)
+            # row i starts at i - j = i - 2
+            terms = windows[n - stop + 1:n - start + 1, :stop - 2][::-1] \
+                + rowTerms[start:stop, None]
+            terms += columnTerms[None, :stop - 2]
+            leaving[2:stop] = np.logaddexp(leaving[2:stop], logSumExp(terms, axis=0))
+        return leaving
+
+    def _conditionedCoalescentDistances(self, n, m, coalescentRate, branchLength):
         """
-        find the ancestors of the given leaf in reverse time order
+        distances between the n - m coalescent events in a branch 
+        (from the bottom of the branch), conditioned on n genes entering 
+        the branch and m genes leaving it; the events are the first n - m 
+        deaths of the pure death process (see _logLineageCountColumn), 
+        whose death times are exponential truncated by the branch length
         """
-        sequence = []
-        for speciesNodeId, mergingSets in coalescentProcess.items():
-            branchDistance = 0.0
-            for mergingSet in mergingSets:
-                branchDistance += mergingSet['distance']
-                if (leafName in mergingSet['fromSet'] 
-                    and leafName not in mergingSet['toSet']):
-                    for element in mergingSet['toSet']:
-                        if (len(leafName) < len(element) 
-                            and self._starInSet(leafName, element)):
-                            coalescentHeight = self.getDistanceToLeaf(
-                                nodeId=speciesNodeId, 
-                                branchDistance=branchDistance)
-                            pair = (element, coalescentHeight)
-                            sequence.append(pair)
-                            sequence += self.__findAncestors(
-                                leafName=element, 
-                                coalescentProcess=coalescentProcess)
-        return sequence
+        if n - m <= 0:
+            return np.empty(0)
+        survival = np.exp(-coalescentRate * branchLength)
+        deaths = n - m
+        if m == 1:
+            # the last gene may die within the branch as well, 
+            # P(all dead) : P(one left) = (1 - s)^n : n s (1 - s)^(n - 1)
+            allDead = 1.0 - survival
+            oneLeft = n * survival
+            if self.randomState.random_sample() * (allDead + oneLeft) < allDead:
+                deaths = n
+        uniforms = self.randomState.random_sample(size=deaths)
+        deathTimes = -np.log1p(-uniforms * (1.0 - survival)) / coalescentRate
+        deathTimes = np.sort(deathTimes)[:n - m]
+        return np.diff(deathTimes, prepend=0.0)
 
     def boundedCoalescent(self, distanceAboveRoot):
         """
@@ -0,0 +1,358 @@
+import os
+import re
+from .exception import *
+
+
+class TreeNode:
+    """
+    Minimal rooted tree used by the simulation in place of
+    skbio.tree.TreeNode: a node only holds its name, the length of
+    the branch above it, its parent and its children, so grafting a
+    subtree is a few assignments; skbio is only imported to convert
+    a tree (toSkbio, fromSkbio) or to draw it (asciiArt)
+    """
+    __slots__ = ('name', 'length', 'parent', 'children', 'id')
+
+    # characters that have to be quoted in a newick label
+    newickOperators = set(',:_;()[]')
+
+    def __init__(self, name=None, length=None):
+        self.name = name
+        self.length = length
+        self.parent = None
+        self.children = []
+        self.id = None
+
+    def __repr__(self):
+        return f'<TreeNode, name: {self.name}, length: {self.length}, children: {len(self.children)}>'
+
+    def __str__(self):
+        return self.toNewick()
+
+    def append(self, child):
+        child.parent = self
+        self.children.append(child)
+
+    def remove(self, child):
+        # by identity, nodes do not define equality
+        for i, node in enumerate(self.children):
+            if node is child:
+                child.parent = None
+                del self.children[i]
+                return True
+        return False
+
+    def isLeaf(self):
+        return not self.children
+
+    def isRoot(self):
+        return self.parent is None
+
+    def preorder(self, includeSelf=True):
+        stack = [self] if includeSelf else self.children[::-1]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children[::-1])
+
+    def postorder(self, includeSelf=True):
+        stack = [(self, False)] if includeSelf else \
+            [(child, False) for child in self.children[::-1]]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded or not node.children:
+                yield node
+            else:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children[::-1])
+
+    def leaves(self):
+        """
+        leaf nodes from left to right, a single node is its own leaf
+        """
+        for node in self.preorder():
+            if not node.children:
+                yield node
+
+    def find(self, name):
+        for node in self.preorder():
+            if node.name == name:
+                return node
+        raise IxDTLError(f'node {name} is not in the tree')
+
+    def copy(self):
+        root = TreeNode(self.name, self.length)
+        stack = [(self, root)]
+        while stack:
+            node, nodeCopy = stack.pop()
+            for child in node.children:
+                childCopy = TreeNode(child.name, child.length)
+                nodeCopy.append(childCopy)
+                stack.append((child, childCopy))
+        return root
+
+    def distance(self, other):
+        """
+        sum of the branch lengths on the path between the two nodes
+        """
+        ancestors = {}
+        distance = 0.0
+        node = self
+        while node is not None:
+            ancestors[id(node)] = distance
+            distance += node.length or 0.0
+            node = node.parent
+        distance = 0.0
+        node = other
+        while id(node) not in ancestors:
+            distance += node.length or 0.0
+            node = node.parent
+            if node is None:
+                raise IxDTLError('the nodes are not in the same tree')
+        return distance + ancestors[id(node)]
+
+    def truncate(self, isLost, inplace=False):
+        """
+        remove the lost lineages in one post order pass: a node is
+        removed if isLost is true for it or if none of its children
+        survives, a node with a single surviving child is replaced by
+        the child, which gets the branch above the node; return the
+        root of the truncated tree or None if everything is lost
+        """
+        tree = self if inplace else self.copy()
+        # survivors[id(node)] = the node taking the place of node, or None
+        survivors = {}
+        stack = [(tree, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if not expanded:
+                if isLost(node):
+                    survivors[id(node)] = None
+                    continue
+                if node.children:
+                    stack.append((node, True))
+                    stack.extend((child, False) for child in node.children)
+                    continue
+                survivors[id(node)] = node
+                continue
+            children = [survivors.pop(id(child)) for child in node.children]
+            children = [child for child in children if child is not None]
+            if not children:
+                survivors[id(node)] = None
+            elif len(children) == 1:
+                child = children[0]
+                if child.length is None or node.length is None:
+                    child.length = child.length or node.length
+                else:
+                    child.length += node.length
+                survivors[id(node)] = child
+            else:
+                node.children = children
+                for child in children:
+                    child.parent = node
+                survivors[id(node)] = node
+        root = survivors[id(tree)]
+        if root is not None:
+            root.parent = None
+        return root
+
+    def toNewick(self):
+        """
+        newick string of the subtree, the same as written by skbio
+        """
+        parts = []
+        depth = 0
+        stack = [(self, 0)]
+        while stack:
+            node, nodeDepth = stack.pop()
+            if node.children and nodeDepth >= depth:
+                parts.append('(')
+                stack.append((node, nodeDepth))
+                stack.extend((child, nodeDepth + 1)
+                    for child in reversed(node.children))
+                depth = nodeDepth + 1
+            else:
+                if nodeDepth < depth:
+                    parts.append(')')
+                    depth -= 1
+                if node.name:
+                    escaped = node.name.replace("'", "''")
+                    if any(c in self.newickOperators for c in node.name):
+                        parts.append("'" + escaped + "'")
+                    else:
+                        parts.append(escaped.replace(' ', '_'))
+                if node.length is not None:
+                    parts.append(':%s' % node.length)
+                if stack and stack[-1][1] == depth:
+                    parts.append(',')
+        parts.append(';\n')
+        return ''.join(parts)
+
+    @classmethod
+    def fromNewick(cls, newick):
+        """
+        read the first tree of a newick string; labels can be quoted
+        ('' for a quote), underscores in unquoted labels are spaces,
+        comments in square brackets are skipped
+        """
+        root = cls()
+        node = root
+        i = 0
+        size = len(newick)
+        while i < size:
+            c = newick[i]
+            if c.isspace():
+                i += 1
+            elif c == '(':
+                child = cls()
+                node.append(child)
+                node = child
+                i += 1
+            elif c == ',':
+                if node.parent is None:
+                    raise IxDTLError('unexpected "," in newick')
+                child = cls()
+                node.parent.append(child)
+                node = child
+                i += 1
+            elif c == ')':
+                if node.parent is None:
+                    raise IxDTLError('unbalanced ")" in newick')
+                node = node.parent
+                i += 1
+            elif c == ';':
+                break
+            elif c == '[':
+                end = newick.find(']', i)
+                if end < 0:
+                    raise IxDTLError('unterminated comment in newick')
+                i = end + 1
+            elif c == ':':
+                i += 1
+                start = i
+                while i < size and newick[i] not in '(),;[' \
+                        and not newick[i].isspace():
+                    i += 1
+                try:
+                    node.length = float(newick[start:i])
+                except ValueError:
+                    raise IxDTLError(
+                        f'invalid branch length "{newick[start:i]}" in newick')
+            elif c == "'":
+                label = []
+                i += 1
+                while True:
+                    end = newick.find("'", i)
+                    if end < 0:
+                        raise IxDTLError('unterminated quoted label in newick')
+                    label.append(newick[i:end])
+                    i = end + 1
+                    if i < size and newick[i] == "'":
+                        label.append("'")
+                        i += 1
+                    else:
+                        break
+                node.name = ''.join(label)
+            else:
+                start = i
+                while i < size and newick[i] not in '(),:;[' \
+                        and not newick[i].isspace():
+                    i += 1
+                node.name = newick[start:i].replace('_', ' ')
+        if node is not root:
+            raise IxDTLError('unbalanced "(" in newick')
+        return root
+
+    @classmethod
+    def fromSkbio(cls, skbioTree):
+        root = cls(skbioTree.name, skbioTree.length)
+        stack = [(skbioTree, root)]
+        while stack:
+            skbioNode, node = stack.pop()
+            for skbioChild in skbioNode.children:
+                child = cls(skbioChild.name, skbioChild.length)
+                node.append(child)
+                stack.append((skbioChild, child))
+        return root
+
+    def toSkbio(self):
+        import skbio
+        root = skbio.tree.TreeNode(name=self.name, length=self.length)
+        stack = [(self, root)]
+        while stack:
+            node, skbioNode = stack.pop()
+            for child in node.children:
+                skbioChild = skbio.tree.TreeNode(
+                    name=child.name, length=child.length)
+                skbioNode.append(skbioChild)
+                stack.append((child, skbioChild))
+        return root
+
+    def asciiArt(self):
+        return self.toSkbio().ascii_art()
+
+
+class GeneTreeNode(TreeNode):
+    """
+    Node of a haplotype (gene) tree: it holds the clade of the gene, or
+    the event ('d_lv=.._id=..') of a node created by a duplication or 
+    transfer, whether the gene is lost and the '_lv=.._id=..' of the
+    graft of the nested tree it is the root of; the name is only built 
+    from these for the output (HaplotypeTree.nameNodes)
+    """
+    __slots__ = ('clade', 'event', 'lost', 'graft')
+
+    def __init__(self, clade=None, length=None, event=None):
+        super().__init__(length=length)
+        self.clade = clade
+        self.event = event
+        self.lost = False
+        self.graft = None
+
+
+# characters that can end a tree in a newick file
+newickSpecials = re.compile(r"[;'\[\]]")
+
+def readNewickTrees(path, chunkSize=1 << 16):
+    """
+    newick strings of the trees in a file, or in the files of a
+    directory in name order, read lazily one tree at a time; a tree
+    ends with a ';' outside quoted labels and comments
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in sorted(os.listdir(path))
+            if not name.startswith('.')
+            and os.path.isfile(os.path.join(path, name))]
+    else:
+        paths = [path]
+
+    for filePath in paths:
+        with open(filePath) as f:
+            buffer = ''
+            quoted = False
+            commentDepth = 0
+            while True:
+                chunk = f.read(chunkSize)
+                if not chunk:
+                    break
+                scanned = len(buffer)
+                buffer += chunk
+                treeStart = 0
+                for match in newickSpecials.finditer(buffer, scanned):
+                    c = match.group()
+                    if c == "'":
+                        if not commentDepth:
+                            quoted = not quoted
+                    elif quoted:
+                        continue
+                    elif c == '[':
+                        commentDepth += 1
+                    elif c == ']':
+                        commentDepth = max(0, commentDepth - 1)
+                    elif not commentDepth:
+                        yield buffer[treeStart:match.end()].strip()
+                        treeStart = match.end()
+                buffer = buffer[treeStart:]
+            # a last tree without ';'
+            if buffer.strip():
+                yield buffer.strip()
@@ -1,181 +1,279 @@
-import skbio
+import numpy as np
 from .util import *
+from .tree_node import *
+from .exception import *
 
 
 class TreeTableEntry:
-    def __init__(self):
-        self.__id = None
-        self.__fakeId = None
-        self.__name = None
-        self.__parent = None
-        self.__distanceToParent = None
-        self.__children = []
-        self.__distanceToChildren = []
-        self.__clades = []
-        self.__splits = []
+    """
+    Thin view of one row of a TreeTable, the node itself is stored
+    in the columns of the table
+    """
+    __slots__ = ('__table', '__row')
+
+    def __init__(self, table, row):
+        self.__table = table
+        self.__row = row
 
     def __repr__(self):
-        return (f'<TreeTableEntry, id: {self.__id}, fakeId: {self.__fakeId}, name: {self.__name}, '
-                f'parent: {self.__parent}, distanceToParent: {self.__distanceToParent}, '
-                f'children: {self.__children}, distanceToChildren: {self.__distanceToChildren}, '
-                f'clades: {self.__clades}, splits: {self.__splits}>')
+        return (f'<TreeTableEntry, id: {self.id}, fakeId: {self.fakeId}, name: {self.name}, '
+                f'parent: {self.parent}, distanceToParent: {self.distanceToParent}, '
+                f'children: {self.children}, distanceToChildren: {self.distanceToChildren}, '
+                f'clades: {self.clades}, splits: {self.splits}>')
 
     def __str__(self):
-        return (f'<TreeTableEntry, id: {self.__id}, fakeId: {self.__fakeId}, name: {self.__name}, '
-                f'parent: {self.__parent}, distanceToParent: {self.__distanceToParent}, '
-                f'children: {self.__children}, distanceToChildren: {self.__distanceToChildren}, '
-                f'clades: {self.__clades}, splits: {self.__splits}>')
+        return self.__repr__()
 
     @property
     def id(self):
-        return self.__id
-    @id.setter
-    def id(self, id):
-        self.__id = id
+        return int(self.__table.ids[self.__row])
 
     @property
     def fakeId(self):
-        return self.__fakeId
-    @fakeId.setter
-    def fakeId(self, fakeId):
-        self.__fakeId = fakeId
+        return int(self.__table.fakeIds[self.__row])
 
     @property
     def name(self):
-        return self.__name
-    @name.setter
-    def name(self, name):
-        self.__name = name
+        return self.__table.names[self.__row]
 
     @property
     def parent(self):
-        return self.__parent
-    @parent.setter
-    def parent(self, parent):
-        self.__parent = parent
+        return int(self.__table.parents[self.__row])
 
     @property
     def distanceToParent(self):
-        return self.__distanceToParent
-    @distanceToParent.setter
-    def distanceToParent(self, distanceToParent):
-        self.__distanceToParent = distanceToParent
+        return float(self.__table.distancesToParent[self.__row])
 
     @property
     def children(self):
-        return self.__children
-    @children.setter
-    def children(self, children):
-        self.__children = children
+        return [int(child) for child in self.__table.children[self.__row]
+            if child >= 0]
 
     @property
     def distanceToChildren(self):
-        return self.__distanceToChildren
-    @distanceToChildren.setter
-    def distanceToChildren(self, distanceToChildren):
-        self.__distanceToChildren = distanceToChildren
+        return [self.__table.getEntryById(child).distanceToParent
+            for child in self.children]
 
     @property
     def clades(self):
-        return self.__clades
+        return self.__table.clades[self.__row]
     @clades.setter
     def clades(self, clades):
-        self.__clades = clades
+        self.__table.clades[self.__row] = clades
 
+    # clades of the children
     @property
     def splits(self):
-        return self.__splits
-    @splits.setter
-    def splits(self, splits):
-        self.__splits = splits
+        return [self.__table.getEntryById(child).clades
+            for child in self.children]
 
 class TreeTable:
+    """
+    Columnar tree table, row i holds the node with the i-th smallest id:
+        ids, parents (id, -1 for the root of a tree), children (ids of
+        the first and second child, -1 if missing), distancesToParent,
+        heights (above the bottom of the tree), fakeIds (post order index)
+    are NumPy arrays, names and clades (bitmasks that can be larger than
+    64 bits) are lists
+    """
     def __init__(self):
-        self.__skbioTree = None
-        self.__table = []
-        self.__tableDictId = {}
-        self.__tableDictName = {}
-        self.__root = None
-        self.__leaves = []
+        self.__tree = None
+        self.__ids = np.zeros(0, dtype=np.int64)
+        self.__parents = np.zeros(0, dtype=np.int64)
+        self.__children = np.zeros((0, 2), dtype=np.int64)
+        self.__distancesToParent = np.zeros(0)
+        self.__heights = np.zeros(0)
+        self.__fakeIds = np.zeros(0, dtype=np.int64)
+        self.__names = []
+        self.__clades = []
+        # None when ids are 0..n-1, i.e., the row of a node is its id
+        self.__rowsById = None
+        # only named nodes can be found by name
+        self.__rowsByName = {}
+        # tree node of each row, for a table created from a tree
+        self.__treeNodes = []
+        # rows in post order and the position of each row in it, with 
+        # the size of the subtree of each row, built on first use
+        self.__postorderRows = None
+        self.__postorderPositions = None
+        self.__subtreeSizes = None
+        self.__rootRow = -1
+        self.__leafRows = []
         self.__treeHeight = -1
 
     def __repr__(self):
         string = '<TreeTable, \n'
-        for entry in self.__table:
+        for entry in self.table:
             string += '  ' + str(entry) + '\n'
         string += '>'
         return string
 
     def __str__(self):
-        string = '<TreeTable, \n'
-        for entry in self.__table:
-            string += '  ' + str(entry) + '\n'
-        string += '>'
-        return string
+        return self.__repr__()
+
+    @property
+    def tree(self):
+        return self.__tree
+    @tree.setter
+    def tree(self, tree):
+        # walk from any leaf node up to the root
+        treeHeight = 0.0
+        node = next(tree.leaves())
+        while node is not tree:
+            treeHeight += node.length
+            node = node.parent
+        self.graftRoot(tree, treeHeight)
+
+    def graftRoot(self, tree, treeHeight):
+        """
+        replace the tree by one grafted above the current root
+        at the given height, the heights of the nodes in the table
+        do not change
+        """
+        self.__treeHeight = treeHeight
+        self.__tree = tree
+
+    @property
+    def ids(self):
+        return self.__ids
+
+    @property
+    def parents(self):
+        return self.__parents
+
+    @property
+    def children(self):
+        return self.__children
+
+    @property
+    def distancesToParent(self):
+        return self.__distancesToParent
+
+    @property
+    def heights(self):
+        return self.__heights
+
+    @property
+    def fakeIds(self):
+        return self.__fakeIds
 
     @property
-    def skbioTree(self):
-        return self.__skbioTree
-    @skbioTree.setter
-    def skbioTree(self, skbioTree):
-        leaveNode = None
-        for node in skbioTree.tips():
-            leaveNode = node
-            break
-        self.__treeHeight = skbioTree.distance(leaveNode)
-        self.__skbioTree = skbioTree
+    def names(self):
+        return self.__names
+
+    @property
+    def clades(self):
+        return self.__clades
 
     @property
     def table(self):
-        return self.__table
+        return [TreeTableEntry(self, row) for row in range(len(self.__ids))]
 
     @property
     def root(self):
-        return self.__root
+        return TreeTableEntry(self, self.__rootRow)
 
     @property
     def leaves(self):
-        return self.__leaves
+        return [TreeTableEntry(self, row) for row in self.__leafRows]
 
     @property
     def treeHeight(self):
         return self.__treeHeight
 
+    def getRow(self, id):
+        return id if self.__rowsById is None else self.__rowsById[id]
+
+    def getRows(self, ids):
+        """
+        rows of an array of ids, the ids are sorted along the rows
+        """
+        if self.__rowsById is None:
+            return np.asarray(ids)
+        return np.searchsorted(self.__ids, ids)
+
     def getEntryById(self, id):
-        return self.__tableDictId[id]
+        return TreeTableEntry(self, self.getRow(id))
 
     def getEntryByName(self, name):
-        return self.__tableDictName[name]
-    
+        return TreeTableEntry(self, self.__rowsByName[name])
+
+    def getTreeNodeById(self, id):
+        return self.__treeNodes[self.getRow(id)]
+
+    def refreshNames(self):
+        """
+        read the names of the tree nodes again, after they were renamed
+        """
+        self.__rowsByName = {}
+        for row, treeNode in enumerate(self.__treeNodes):
+            self.__names[row] = treeNode.name
+            if treeNode.name is not None:
+                self.__rowsByName[treeNode.name] = row
+
     def getFakeIdFromId(self, id):
-        return self.__tableDictId[id].fakeId
-
-    def createFromEntries(self, entries, skbioTree):
-        self.__skbioTree = skbioTree
-        for entry in entries:
-            self.__table.append(entry)
-            self.__tableDictId[entry.id] = entry
-            self.__tableDictName[entry.name] = entry
-            if entry.name == skbioTree.name:
-                self.__root = entry
-            if skbioTree.find(entry.name).is_tip():
-                self.__leaves.append(entry)
-        
-        # sort the table by id
-        self.__table.sort(key=lambda x: x.id)
-
-        # calculate tree height (any leaf node to the root)
-        self.__treeHeight = self.__distanceToRoot(self.leaves[0].id)
-
-    def createFromSkbioTree(self, skbioTree, rename=True):
-        if rename:
-            # rename all tree nodes
-            self.__renameTreeNodes(skbioTree)
+        return int(self.__fakeIds[self.getRow(id)])
 
+    def getSubtreeRows(self, id):
+        """
+        rows of the subtree rooted at the node in post order (children 
+        before parents), a subtree is a contiguous range of the post 
+        order so the rows are a view, not a copy
+        """
+        if self.__postorderRows is None:
+            self.__buildPostorder()
+        row = self.getRow(id)
+        end = self.__postorderPositions[row] + 1
+        return self.__postorderRows[end - self.__subtreeSizes[row]:end]
+
+    def __buildPostorder(self):
+        # fake ids are the post order
+        self.__postorderRows = np.argsort(self.__fakeIds, kind='stable')
+        self.__postorderPositions = np.empty_like(self.__postorderRows)
+        self.__postorderPositions[self.__postorderRows] = \
+            np.arange(len(self.__postorderRows))
+        sizes = [1] * len(self.__ids)
+        children = self.__children.tolist()
+        for row in self.__postorderRows.tolist():
+            for child in children[row]:
+                if child >= 0:
+                    sizes[row] += sizes[self.getRow(child)]
+        self.__subtreeSizes = np.array(sizes)
+
+    def createFromEntries(self, entries, tree):
+        self.__tree = tree
+        rows = sorted(entries, key=lambda x: x.id)
+        self.__allocate(len(rows))
+        for row, entry in enumerate(rows):
+            self.__ids[row] = entry.id
+            self.__parents[row] = entry.parent
+            self.__distancesToParent[row] = entry.distanceToParent
+            self.__fakeIds[row] = entry.fakeId
+            children = entry.children
+            self.__children[row, :len(children)] = children
+            self.__names[row] = entry.name
+            self.__clades[row] = entry.clades
+            if entry.name is not None:
+                self.__rowsByName[entry.name] = row
+            if entry.id == tree.id:
+                self.__rootRow = row
+        if not np.array_equal(self.__ids, np.arange(len(rows))):
+            self.__rowsById = {id: row for row, id in enumerate(self.__ids.tolist())}
+        self.__leafRows = [self.getRow(entry.id) for entry in entries
+            if not entry.children]
+
+        # calculate tree height and node heights
+        self.__computeHeights()
+
+    def createFromTree(self, tree):
+        """
+        the nodes are identified by their ids, not by their names, 
+        which can be any labels or None
+        """
         # assign ids in reversed time order
         queue = Queue()
         visited = set()
-        for treeNode in skbioTree.tips():
+        for treeNode in tree.leaves():
             queue.push(treeNode)
         i = 0
         while not queue.isEmpty():
@@ -183,91 +281,123 @@ class TreeTable:
             visited.add(treeNode)
             treeNode.id = i
             i += 1
-            if treeNode.is_root():
+            if treeNode.isRoot():
                 continue  # equivalently break
-            elif all(True if child in visited else False 
+            elif all(True if child in visited else False
                      for child in treeNode.parent.children):
                 queue.push(treeNode.parent)
 
-        # create entry for each tree node and store in the table
-        for treeNode in skbioTree.traverse():
-            entry = TreeTableEntry()
-            entry.id = treeNode.id
-            entry.name = treeNode.name
-            self.__tableDictId[entry.id] = entry
-            self.__tableDictName[entry.name] = entry
-            if not treeNode.parent:
-                entry.parent = -1
-                entry.distanceToParent = -1.0
+        # fill the row of each tree node, row = id
+        self.__allocate(i)
+        self.__treeNodes = [None] * i
+        for treeNode in tree.preorder():
+            row = treeNode.id
+            self.__ids[row] = row
+            self.__treeNodes[row] = treeNode
+            self.__names[row] = treeNode.name
+            if treeNode.name is not None:
+                self.__rowsByName[treeNode.name] = row
+            if treeNode.parent is None:
+                self.__parents[row] = -1
+                self.__distancesToParent[row] = -1.0
             else:
-                entry.parent = treeNode.parent.id
-                entry.distanceToParent = treeNode.distance(treeNode.parent)
-                parentTreeNode = self.__tableDictId[treeNode.parent.id]
-                parentTreeNode.children.append(entry.id)
-                parentTreeNode.distanceToChildren.append(
-                    treeNode.distance(treeNode.parent))
-            self.__table.append(entry)
-
-            if treeNode.is_tip():
-                self.__leaves.append(entry)
+                self.__parents[row] = treeNode.parent.id
+                self.__distancesToParent[row] = treeNode.length or 0.0
+            if len(treeNode.children) > 2:
+                raise IxDTLError(f'tree node {treeNode.name} has more than two children')
+            for index, child in enumerate(treeNode.children):
+                self.__children[row, index] = child.id
 
-        # sort the table by id
-        self.__table.sort(key=lambda x: x.id)
+            if treeNode.isLeaf():
+                self.__leafRows.append(row)
 
-        # get the root
-        self.__root = self.__table[-1]
+        # the root has the largest id
+        self.__rootRow = i - 1
 
         # assign fake ids in post order
-        self.__assignFakeIds(skbioTree)
+        for index, treeNode in enumerate(tree.postorder()):
+            self.__fakeIds[treeNode.id] = index
 
-        # calculate tree height (any leaf node to the root)
-        self.__treeHeight = self.__distanceToRoot(self.leaves[0].id)
+        # calculate tree height and node heights
+        self.__computeHeights()
 
-        self.__skbioTree = skbioTree
+        self.__tree = tree
 
-        return skbioTree
+        return tree
 
     def createFromNewickFile(self, path):
         f = open(path)
-        skbioTree = skbio.read(f, format="newick", into=skbio.tree.TreeNode)
+        tree = TreeNode.fromNewick(f.read())
         f.close()
-        return self.createFromSkbioTree(skbioTree)
-
-    def __renameTreeNodes(self, skbioTree):
-        if skbioTree.name:
-            return skbioTree.name
-        else:
-            name = ''
-            for child in skbioTree.children:
-                name += self.__renameTreeNodes(child)
-            skbioTree.name = name
-            return skbioTree.name
-
-    def __assignFakeIds(self, skbioTree):
-        index = 0
-        for treeNode in skbioTree.postorder():
-            entry = self.getEntryById(treeNode.id)
-            entry.fakeId = index
-            index += 1
-
-    def __distanceToRoot(self, nodeId):
+        return self.createFromTree(tree)
+
+    def createFromNewick(self, newick):
+        return self.createFromTree(TreeNode.fromNewick(newick))
+
+    def __allocate(self, size):
+        self.__ids = np.zeros(size, dtype=np.int64)
+        self.__parents = np.full(size, -1, dtype=np.int64)
+        self.__children = np.full((size, 2), -1, dtype=np.int64)
+        self.__distancesToParent = np.zeros(size)
+        self.__heights = np.zeros(size)
+        self.__fakeIds = np.full(size, -1, dtype=np.int64)
+        self.__names = [None] * size
+        self.__clades = [0] * size
+        self.__rowsById = None
+        self.__rowsByName = {}
+        self.__treeNodes = []
+        self.__postorderRows = None
+        self.__postorderPositions = None
+        self.__subtreeSizes = None
+        self.__leafRows = []
+
+    def __computeHeights(self):
         """
-        find the distance of a given node to the root 
-        needed when finding the walking distance
+        find the distance of every node to the root by pointer jumping,
+        distances[row] is the distance to ancestors[row], each step
+        doubles the number of branches covered until every ancestor is
+        the root; then the tree height (any leaf node to the root) and
+        the height of every node above the bottom of the tree
         """
-        if (self.getEntryById(nodeId).parent < 0 or 
-            nodeId == self.root.id):
-            return 0
-        else:
-            distanceToParent = self.getEntryById(nodeId).distanceToParent
-            parent = self.getEntryById(nodeId).parent
-            return distanceToParent + self.__distanceToRoot(parent)
+        rows = np.arange(len(self.__ids))
+        isRoot = rows == self.__rootRow
+        ancestors = rows.copy()
+        ancestors[~isRoot] = self.getRows(self.__parents[~isRoot])
+        distances = np.where(isRoot, 0.0, self.__distancesToParent)
+        while (ancestors != self.__rootRow).any():
+            distances = distances + distances[ancestors]
+            ancestors = ancestors[ancestors]
+        self.__treeHeight = float(distances[self.__leafRows[0]])
+        self.__heights = self.__treeHeight - distances
 
     def distanceToLeaf(self, nodeId, branchDistance):
         """
-        given a coalescent event happening at "branchDistance" above 
-        a speices node with "nodeId" find the distance of this event 
-        to the bottom of the tree needed when assigning ids to the 
+        given a coalescent event happening at "branchDistance" above
+        a speices node with "nodeId" find the distance of this event
+        to the bottom of the tree needed when assigning ids to the
         coalescent tree
         """
-        return branchDistance + (self.treeHeight - self.__distanceToRoot(nodeId))
\ No newline at end of file
+        return branchDistance + float(self.__heights[self.getRow(nodeId)])
+
+    def meanOverClades(self, values):
+        """
+        mean of the values of the extant species (rows of values, 
+        indexed by species leaf id) in the clade of every node, by row;
+        the clade of an inner node is the union of the disjoint clades
+        of its children, so the sums are gathered from the children 
+        (rows are sorted by id, children before parents)
+        """
+        values = np.asarray(values, dtype=float)
+        sums = np.zeros((len(self.__ids),) + values.shape[1:])
+        counts = np.zeros(len(self.__ids))
+        for row in range(len(self.__ids)):
+            children = self.__children[row]
+            if children[0] < 0:
+                ids = cladeToIds(self.__clades[row])
+                sums[row] = values[ids].sum(axis=0)
+                counts[row] = len(ids)
+            else:
+                childRows = self.getRows(children[children >= 0])
+                sums[row] = sums[childRows].sum(axis=0)
+                counts[row] = counts[childRows].sum()
+        return sums / counts.reshape((-1,) + (1,) * (values.ndim - 1))
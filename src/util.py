@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class Queue:
     def __init__(self):
         self.list = []
@@ -10,3 +13,49 @@ class Queue:
 
     def isEmpty(self):
         return len(self.list) == 0
+
+
+# clades are represented as integer bitmasks over the ids of the 
+# leaves (extant species) of the species tree, e.g., 
+# species {1, 2, 4} <-> 0b10110; 
+# the "*" representation is only used for naming tree nodes, 
+# e.g., 0b10110 -> '1*2*4*'
+def cladeFromIds(ids):
+    clade = 0
+    for id in ids:
+        clade |= 1 << id
+    return clade
+
+def cladeToIds(clade):
+    # ones of the binary string from the lowest bit, peeling the lowest 
+    # bit off copies the whole bitmask, i.e., quadratic in large clades
+    bits = bin(clade)[:1:-1]
+    ids = []
+    id = bits.find('1')
+    while id >= 0:
+        ids.append(id)
+        id = bits.find('1', id + 1)
+    return ids
+
+def cladeToName(clade):
+    return ''.join([str(id) + '*' for id in cladeToIds(clade)])
+
+def isSubclade(target, clade):
+    """
+    checking whether a given target clade is contained in the clade
+    """
+    return target & clade == target
+
+def logSumExp(values, axis=None):
+    """
+    log(sum(exp(values))) along the axis, without overflow or underflow;
+    -inf where every value is -inf
+    """
+    values = np.asarray(values)
+    maxima = np.max(values, axis=axis, keepdims=True)
+    shifted = values - np.where(np.isfinite(maxima), maxima, 0.0)
+    # terms below exp(-700) of the largest one add nothing to the sum, 
+    # and exp is slow on them
+    np.maximum(shifted, -700.0, out=shifted)
+    sums = np.log(np.sum(np.exp(shifted), axis=axis, keepdims=True)) + maxima
+    return sums.item() if axis is None else np.squeeze(sums, axis=axis)
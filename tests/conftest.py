@@ -0,0 +1,3 @@
+def pytest_configure(config):
+    config.addinivalue_line('markers', 
+        'statistical: seeded checks comparing the distributions of two samplers')
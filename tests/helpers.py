@@ -0,0 +1,60 @@
+import numpy as np
+from src.species_tree import SpeciesTree
+
+
+def makeSpeciesTree(newick, coalescentRate, seed):
+    speciesTree = SpeciesTree(randomState=np.random.RandomState(seed))
+    speciesTree.initialize(newick=newick)
+    speciesTree.setCoalescentRate(coalescentPrmt={'const': coalescentRate})
+    return speciesTree
+
+
+def assertSameMean(samples, others, sigmas=4.0):
+    """
+    the means of two independent samples are within the given number
+    of standard errors of their difference
+    """
+    samples = np.asarray(samples, dtype=float)
+    others = np.asarray(others, dtype=float)
+    error = np.sqrt(samples.var(ddof=1) / len(samples)
+        + others.var(ddof=1) / len(others))
+    difference = abs(samples.mean() - others.mean())
+    assert difference <= sigmas * error + 1e-12, \
+        f'means {samples.mean()} and {others.mean()} differ by {difference / error:.1f} sigmas'
+
+
+def assertSameFrequencies(samples, others, sigmas=4.0):
+    """
+    every value is as frequent in both samples, within the given number
+    of standard errors of the difference of the proportions
+    """
+    samples = np.asarray(samples)
+    others = np.asarray(others)
+    for value in np.union1d(samples, others):
+        p = np.mean(samples == value)
+        q = np.mean(others == value)
+        pooled = (p * len(samples) + q * len(others)) / (len(samples) + len(others))
+        error = np.sqrt(pooled * (1 - pooled) * (1 / len(samples) + 1 / len(others)))
+        assert abs(p - q) <= sigmas * error + 1e-12, \
+            f'value {value} has frequencies {p} and {q}'
+
+
+def assertSameCoalescents(coalescentProcesses, others, nodeIds):
+    """
+    two samples of coalescent processes have the same distribution of 
+    the number of merges in the branch above every species node, and 
+    the same mean height of the merges in the branch, one mean per process
+    """
+    for nodeId in nodeIds:
+        counts, otherCounts = [[len(coalescentProcess.get(nodeId, [])) 
+                for coalescentProcess in processes]
+            for processes in (coalescentProcesses, others)]
+        assertSameMean(counts, otherCounts)
+        assertSameFrequencies(counts, otherCounts)
+        heights, otherHeights = [[np.mean([mergingSet['height'] 
+                for mergingSet in coalescentProcess[nodeId]])
+                for coalescentProcess in processes 
+                if coalescentProcess.get(nodeId)]
+            for processes in (coalescentProcesses, others)]
+        if len(heights) > 1 and len(otherHeights) > 1:
+            assertSameMean(heights, otherHeights)
@@ -0,0 +1,45 @@
+import pytest
+from src.locus_tree import LocusTree
+from src.exception import IxDTLError
+from .helpers import *
+
+NEWICK = '((A:1.0,B:1.0):0.4,(C:0.6,(D:0.3,E:0.3):0.3):0.8);'
+
+
+def makeLocusTree(newick, seed):
+    speciesTree = makeSpeciesTree(newick, coalescentRate=1.0, seed=seed)
+    locusTree = LocusTree(randomState=speciesTree.randomState)
+    locusTree.initialize(speciesTree=speciesTree, rootId=speciesTree.getRoot().id)
+    return locusTree
+
+
+@pytest.mark.statistical
+def testExactMatchesRejection():
+    for distanceAboveRoot in [0.2, 1.0]:
+        exactTree = makeLocusTree(NEWICK, seed=3)
+        exact = [exactTree.boundedCoalescent(distanceAboveRoot, exact=True)
+            for _ in range(2000)]
+        rejectionTree = makeLocusTree(NEWICK, seed=4)
+        rejection = [rejectionTree.boundedCoalescent(distanceAboveRoot, exact=False)
+            for _ in range(2000)]
+        for coalescentProcess in exact:
+            # every gene merged before the top of the root branch
+            assert sum(len(mergingSets) 
+                for mergingSets in coalescentProcess.values()) == 4
+            assert max(mergingSet['height'] 
+                for mergingSets in coalescentProcess.values()
+                for mergingSet in mergingSets) <= 1.4 + distanceAboveRoot
+        assertSameCoalescents(exact, rejection, 
+            [node.id for node in exactTree.getNodes()])
+
+
+def testNoRoomToMerge():
+    locusTree = makeLocusTree('((A:1,B:1):1,C:2);', seed=1)
+    for exact in [True, False]:
+        with pytest.raises(IxDTLError):
+            locusTree.boundedCoalescent(0.0, exact=exact)
+    # the rejection sampler gives up instead of looping forever
+    locusTree.maxBoundedCoalescentAttempts = 1
+    with pytest.raises(IxDTLError):
+        for _ in range(100):
+            locusTree.boundedCoalescent(0.001, exact=False)
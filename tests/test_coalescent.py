@@ -0,0 +1,57 @@
+import pytest
+from .helpers import *
+
+NEWICK = '(((A:0.3,B:0.3):0.4,C:0.7):0.2,((D:0.1,E:0.1):0.3,(F:0.2,G:0.2):0.2):0.5);'
+
+
+def referenceCoalescent(speciesTree, distanceAboveRoot):
+    """
+    the textbook coalescent, one exponential waiting time per event: 
+    while k > 1 genes remain in a branch, the next event is Exp(k * rate) 
+    away, and a random couple merges if it falls within the branch
+    """
+    randomState = speciesTree.randomState
+    rootId = speciesTree.getRoot().id
+    coalescentProcess = {}
+    cladeSet = {}
+    for node in speciesTree.getNodes():
+        if node.children:
+            genes = [gene for child in node.children for gene in cladeSet[child]]
+        else:
+            genes = [1 << node.id]
+        branchLength = distanceAboveRoot \
+            if node.id == rootId else node.distanceToParent
+        coalescentRate = speciesTree._getCoalescentRateInBranch(node.id)
+        nodeHeight = speciesTree.getDistanceToLeaf(node.id, 0)
+        elapsed = 0.0
+        while len(genes) > 1:
+            elapsed += randomState.exponential(
+                scale=1.0 / (len(genes) * coalescentRate))
+            if elapsed > branchLength:
+                break
+            i, j = randomState.choice(len(genes), size=2, replace=False)
+            clade = genes[i] | genes[j]
+            genes = [gene for k, gene in enumerate(genes) if k not in (i, j)]
+            genes.append(clade)
+            coalescentProcess.setdefault(node.id, []).append(
+                {'clade': clade, 'height': nodeHeight + elapsed})
+        cladeSet[node.id] = genes
+    return coalescentProcess, cladeSet[rootId]
+
+
+@pytest.mark.statistical
+def testCoalescentMatchesReference():
+    for distanceAboveRoot in [0.3, float('inf')]:
+        speciesTree = makeSpeciesTree(NEWICK, coalescentRate=1.2, seed=9)
+        samples = [speciesTree.coalescent(distanceAboveRoot)
+            for _ in range(3000)]
+        referenceTree = makeSpeciesTree(NEWICK, coalescentRate=1.2, seed=10)
+        references = [referenceCoalescent(referenceTree, distanceAboveRoot)
+            for _ in range(3000)]
+        assertSameCoalescents(
+            [coalescentProcess for coalescentProcess, _ in samples],
+            [coalescentProcess for coalescentProcess, _ in references],
+            [node.id for node in speciesTree.getNodes()])
+        assertSameFrequencies(
+            [len(genes) for _, genes in samples],
+            [len(genes) for _, genes in references])
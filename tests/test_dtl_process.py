@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+from src.haplotype_tree import HaplotypeTree
+from .helpers import *
+
+NEWICK = '(((A:0.5,B:0.5):1.0,C:1.5):0.5,(D:1.2,(E:0.7,F:0.7):0.5):0.8);'
+EVENT_TYPES = ['duplication', 'transfer', 'loss']
+
+
+def sampleDtlProcess(batched, samples, seed):
+    """
+    the number of events of each type and their heights over the
+    replicates of the dtl process on one haplotype tree
+    """
+    speciesTree = makeSpeciesTree(NEWICK, coalescentRate=1.0, seed=seed)
+    haplotypeTree = HaplotypeTree(
+        randomState=speciesTree.randomState, speciesTree=speciesTree)
+    haplotypeTree.initialize(locusTree=speciesTree)
+    haplotypeTree.setEventRates(duplicationPrmt={'const': 0.3},
+        transferPrmt={'const': 0.2}, lossPrmt={'const': 0.25})
+    counts = {eventType: [] for eventType in EVENT_TYPES}
+    heights = {eventType: [] for eventType in EVENT_TYPES}
+    for _ in range(samples):
+        events = haplotypeTree.dtlProcess(distanceAboveRoot=0, batched=batched)
+        for eventType in EVENT_TYPES:
+            typed = [event for event in events if event['type'] == eventType]
+            counts[eventType].append(len(typed))
+            heights[eventType].extend(event['eventHeight'] for event in typed)
+    return counts, heights
+
+
+@pytest.mark.statistical
+def testBatchedMatchesRecursion():
+    batchedCounts, batchedHeights = sampleDtlProcess(
+        batched=True, samples=3000, seed=5)
+    counts, heights = sampleDtlProcess(batched=False, samples=3000, seed=5)
+    for eventType in EVENT_TYPES:
+        assert np.mean(batchedCounts[eventType]) > 0.1
+        assertSameMean(batchedCounts[eventType], counts[eventType])
+        assertSameFrequencies(batchedCounts[eventType], counts[eventType])
+        assertSameMean(batchedHeights[eventType], heights[eventType])
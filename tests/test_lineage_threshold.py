@@ -0,0 +1,34 @@
+import pytest
+from .helpers import *
+
+NEWICK = ('(((A:0.2,B:0.2):0.1,(C:0.2,D:0.2):0.1):0.15,'
+    '((E:0.1,F:0.1):0.2,(G:0.25,(H:0.1,I:0.1):0.15):0.05):0.15);')
+
+
+def sampleCoalescent(lineageThreshold, distanceAboveRoot, samples, seed):
+    """
+    coalescent processes and numbers of genes leaving the root branch
+    """
+    speciesTree = makeSpeciesTree(NEWICK, coalescentRate=1.5, seed=seed)
+    speciesTree.lineageThreshold = lineageThreshold
+    coalescentProcesses = []
+    genesIntoRoot = []
+    for _ in range(samples):
+        coalescentProcess, genes = speciesTree.coalescent(distanceAboveRoot)
+        coalescentProcesses.append(coalescentProcess)
+        genesIntoRoot.append(len(genes))
+    return coalescentProcesses, genesIntoRoot
+
+
+@pytest.mark.statistical
+def testClosedFormMatchesDefault():
+    nodeIds = [node.id for node in makeSpeciesTree(NEWICK, 1.5, 0).getNodes()]
+    for distanceAboveRoot in [0.3, float('inf')]:
+        closedForm, genesIntoRoot = sampleCoalescent(lineageThreshold=2,
+            distanceAboveRoot=distanceAboveRoot, samples=3000, seed=7)
+        default, defaultGenesIntoRoot = sampleCoalescent(lineageThreshold=None,
+            distanceAboveRoot=distanceAboveRoot, samples=3000, seed=8)
+        assertSameCoalescents(closedForm, default, nodeIds)
+        assertSameFrequencies(genesIntoRoot, defaultGenesIntoRoot)
+        if distanceAboveRoot == float('inf'):
+            assert set(genesIntoRoot) == {1}